@@ -1,7 +1,14 @@
 import streamlit as st
 import os
-import glob
-import PIL.Image
+import time
+
+from law_corpus import CorpusLoader, load_corpus, DOC_HEADER
+from gen_cache import GenerationCache, cached_generate_stream
+from photos import prepare_photo_bytes, make_thumbnail
+from model_selector import ModelSelector
+from context_cache import ContextCacheManager, CACHED_CORPUS_NOTE
+from chat_memory import ChatMemory, format_turn
+from kb_budget import TokenCounter, budget_context, format_report
 
 # --- ИСПОЛЬЗУЕМ НОВУЮ БИБЛИОТЕКУ (КАК В ROBOT) ---
 from google import genai
@@ -56,25 +63,42 @@ MODEL_CANDIDATES = [
 ]
 
 @st.cache_resource
-def get_working_model_name():
-    """Проверяет, какая модель доступна, используя новый SDK"""
-    for model_name in MODEL_CANDIDATES:
-        try:
-            client.models.generate_content(model=model_name, contents="Ping")
-            return model_name
-        except Exception:
-            continue
-    return None
+def get_model_selector():
+    """Выбор модели один раз на процесс: последняя рабочая модель берется с диска, Ping — только если запись устарела"""
+    selector = ModelSelector(MODEL_CANDIDATES, os.path.join(".cache", "model_state.json"))
+    selector.select(client)
+    return selector
 
-active_model_name = get_working_model_name()
+model_selector = get_model_selector()
+active_model_name = model_selector.active
 
 if not active_model_name:
+    get_model_selector.clear()  # следующая загрузка страницы проверит модели заново
     st.error("Сервер перегружен или ключ не подходит к моделям. Попробуйте позже.")
     st.stop()
 else:
     # Показываем (для отладки можно убрать), какая модель подхватилась
     print(f"Streamlit active model: {active_model_name}")
 
+ANSWER_CACHE_MAX_MB = 50
+ANSWER_CACHE_DAYS = 7 # Ответы старше недели генерируются заново
+
+@st.cache_resource
+def get_answer_cache():
+    """Общий для всех сессий дисковый кэш готовых ответов: ключ — нормализованный вопрос,
+    язык и версия базы законов; LRU по размеру + срок жизни (ALMA_NO_CACHE=1 — отключить)"""
+    return GenerationCache(os.path.join(".cache", "answer_cache.sqlite"),
+                           max_mb=ANSWER_CACHE_MAX_MB, max_age_days=ANSWER_CACHE_DAYS)
+
+@st.cache_resource
+def get_generation_cache():
+    """Кэш точных запросов (промпт, фото, история): повтор того же вопроса с тем же фото
+    или в том же разговоре не идет в модель (ALMA_NO_CACHE=1 — отключить)"""
+    return GenerationCache(os.path.join(".cache", "gen_cache.sqlite"))
+
+answer_cache = get_answer_cache()
+gen_cache = get_generation_cache()
+
 # --- 4. ДИСКЛЕЙМЕР ---
 with st.expander("📜 Условия использования / Пайдалану шарттары", expanded=True):
     st.warning("""
@@ -88,62 +112,83 @@ if not agreement:
     st.stop()
 
 # --- 5. ЗАГРУЗКА БАЗЫ ЗНАНИЙ ---
-FILE_MAPPING = {
-    "00_guidelines.txt": "Руководство и Стратегия ALMA",
-    "01_land_code.txt": "Земельный кодекс РК",
-    "02_eco_code.txt": "Экологический кодекс РК",
-    "03_water_code.txt": "Водный кодекс РК",
-    "04_adm_code.txt": "Кодекс об административных правонарушениях (КоАП)",
-    "05_crime_code.txt": "Уголовный кодекс РК",
-    "06_law_architecture.txt": "Закон об архитектурной и градостроительной деятельности",
-    "07_almaty_rules.txt": "Правила застройки, ПЗЗ и Генплан Алматы",
-    "08_biodiversity.txt": "Законодательство о биоразнообразии и ООПТ",
-    "09_climate_adaptation.txt": "Климатическая стратегия и адаптация",
-    "10_presidential_acts.txt": "Акты и Поручения Президента РК",
-    "11_paris_agreement.txt": "Парижское соглашение (Климат)",
-    "12_biodiversity_convention.txt": "Конвенция о биологическом разнообразии",
-    "13_aarhus_convention.txt": "Орхусская конвенция (Права общественности)",
-    "14_land_inspection.txt": "Полномочия Земельной инспекции (ДУЗР МСХ РК)"
-}
+LAW_TOKEN_BUDGET = int(os.environ.get("ALMA_LAW_TOKENS", "6000")) # Токенов базы знаний в ответе (руководство + статьи по приоритету)
 
 @st.cache_resource
-def load_knowledge():
-    knowledge = ""
-    folder_path = "laws"
+def get_corpus():
+    """Скомпилированная база законов, общая для всех сессий (None, если папки laws нет)"""
     # Проверка существования папки (Streamlit Cloud sometimes needs relative paths)
-    if not os.path.exists(folder_path):
-        # Попробуем поискать в текущей директории или уровнем выше
-        if os.path.exists("./laws"):
-            folder_path = "./laws"
-        else:
-            return "ERROR: Folder 'laws' not found."
-    
-    files = sorted(glob.glob(os.path.join(folder_path, "*.txt")))
-    if not files:
-        return "ERROR: No text files found."
+    if not os.path.exists("laws"):
+        return None
+    return CorpusLoader("laws")
 
-    for file_path in files:
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                filename_raw = os.path.basename(file_path)
-                doc_title = FILE_MAPPING.get(filename_raw, filename_raw)
-                knowledge += f"\n\n--- ДОКУМЕНТ: {doc_title} ---\n"
-                knowledge += f.read()
-        except Exception as e:
-            knowledge += f"\n[Error reading {file_path}: {e}]\n"
-    return knowledge
+def load_knowledge():
+    """Текущая версия базы: при изменении laws/ файл пересобирается и перечитывается без перезапуска"""
+    corpus = get_corpus()
+    if corpus is None:
+        return None
+    law_index = corpus.current()
+    if not law_index.chunks and not law_index.guidelines:
+        return None
+    return law_index
 
-knowledge_base = load_knowledge()
+law_index = load_knowledge()
+
+@st.cache_resource
+def get_token_counter():
+    """Оценка токенов, один раз сверенная с токенизатором активной модели"""
+    counter = TokenCounter()
+    if law_index:
+        counter.calibrate(client, active_model_name, law_index.guidelines)
+    return counter
+
+token_counter = get_token_counter()
+
+def build_cached_corpus():
+    """Содержимое кэша контекста: вся база, перечитанная с диска"""
+    system_instruction = "ТЫ — Виртуальный Юрист ALMA (Alma Zanger). Ниже — твоя база знаний: руководство ALMA и законы РК."
+    return system_instruction, load_corpus("laws").full_text(header=DOC_HEADER)
+
+@st.cache_resource
+def get_context_cache():
+    """Вся база один раз в кэше контекста Gemini (ALMA_CONTEXT_CACHE=1), общий для всех сессий"""
+    return ContextCacheManager(
+        client, get_corpus(), build_cached_corpus,
+        state_path=os.path.join(".cache", "context_cache.json"),
+        enabled=os.environ.get("ALMA_CONTEXT_CACHE", "") == "1",
+    )
+
+context_cache = get_context_cache()
+
+def summarize_turns(summary, turns):
+    """Сворачивает старые реплики в краткое содержание (ChatMemory вызывает, когда окно переполнено)"""
+    request = f"""Сожми переписку Юриста ALMA с пользователем в краткое содержание (не больше 10 строк):
+    суть проблемы, место, упомянутые законы и данные советы. Пиши на языке переписки.
+    ПРЕДЫДУЩЕЕ КРАТКОЕ СОДЕРЖАНИЕ:
+    {summary or "—"}
+    НОВЫЕ СООБЩЕНИЯ:
+    {chr(10).join(format_turn(m) for m in turns)}
+    """
+    resp = client.models.generate_content(
+        model=model_selector.current(), contents=request,
+        config=types.GenerateContentConfig(temperature=0.0, max_output_tokens=500)
+    )
+    if not resp.text:
+        raise ValueError("пустой ответ модели")
+    return resp.text
 
 # --- 6. ЧАТ И ЗАГРУЗКА ФОТО ---
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "memory" not in st.session_state:
+    st.session_state.memory = ChatMemory(counter=token_counter)
 
 # Очистка при смене языка
 if "last_lang" not in st.session_state:
     st.session_state.last_lang = selected_lang
 if st.session_state.last_lang != selected_lang:
     st.session_state.messages = []
+    st.session_state.memory = ChatMemory(counter=token_counter)
     st.session_state.last_lang = selected_lang
 
 # Приветствие
@@ -152,13 +197,15 @@ if not st.session_state.messages:
         welcome = "Здравствуйте! Опишите проблему или прикрепите фото нарушения."
     else:
         welcome = "Сәлеметсіз бе! Мәселені сипаттаңыз немесе бұзушылықтың суретін тіркеңіз."
-    st.session_state.messages.append({"role": "assistant", "content": welcome})
+    st.session_state.messages.append({"role": "assistant", "content": welcome, "skip_memory": True})
 
 for msg in st.session_state.messages:
     with st.chat_message(msg["role"]):
-        if "image" in msg:
-            st.image(msg["image"], caption="Загруженное фото", width=300)
+        if "thumb" in msg:
+            st.image(msg["thumb"], caption="Загруженное фото", width=300)
         st.write(msg["content"])
+        if "timing" in msg:
+            st.caption(msg["timing"])
 
 # Загрузка фото
 label_upload = "📸 Загрузить фото (Опционально) / Фотосурет жүктеу (Міндетті емес)"
@@ -172,14 +219,19 @@ if prompt := st.chat_input(prompt_text):
     user_msg_obj = {"role": "user", "content": prompt}
     
     # Обработка фото
-    pil_image = None
+    photo = None
     if uploaded_file:
-        user_msg_obj["image"] = uploaded_file
         try:
-            pil_image = PIL.Image.open(uploaded_file)
+            # Та же подготовка, что у робота: одно декодирование и уменьшенный JPEG для модели.
+            # В истории сессии остаются только миниатюра и хэш, а не сам файл.
+            photo = prepare_photo_bytes(uploaded_file.getvalue(), uploaded_file.name)
+            user_msg_obj["thumb"] = make_thumbnail(photo["jpeg"])
+            user_msg_obj["image_hash"] = photo["hash"]
         except Exception as e:
             st.error(f"Ошибка обработки фото: {e}")
 
+    memory = st.session_state.memory
+    history = list(st.session_state.messages)
     st.session_state.messages.append(user_msg_obj)
     
     with st.chat_message("user"):
@@ -190,6 +242,8 @@ if prompt := st.chat_input(prompt_text):
     with st.chat_message("assistant"):
         placeholder = st.empty()
         full_response = ""
+        # Время до первого фрагмента — с момента вопроса: кэш, история и кэш контекста тоже в него входят
+        started = time.perf_counter()
         
         # Выбор языка
         if "Русский" in selected_lang:
@@ -199,6 +253,29 @@ if prompt := st.chat_input(prompt_text):
             target_lang = "КАЗАХСКИЙ (Қазақ тілі)"
             forbidden_lang = "Русский"
 
+        # Одинаковые первые вопросы без фото отвечаем из общего кэша; с фото или в продолжении
+        # разговора ответ зависит не только от вопроса — там совпадать должен весь запрос (gen_cache)
+        first_question = not any(m["role"] == "user" for m in history)
+        answer_key = None
+        if answer_cache.enabled and first_question and not uploaded_file and law_index:
+            answer_key = answer_cache.make_answer_key(target_lang, law_index.version, prompt)
+        cached_answer = answer_cache.get(answer_key) if answer_key else None
+
+        # Предыдущие реплики: окно последних в пределах бюджета токенов + краткое содержание старых
+        conversation = "" if cached_answer else memory.context(history)
+
+        model_name = model_selector.current()
+        # База уже в кэше контекста — передаем только ссылку; иначе статьи, относящиеся к вопросу
+        cache_name = context_cache.get(model_name) if law_index and not cached_answer else None
+        if cache_name:
+            knowledge_base = CACHED_CORPUS_NOTE
+        elif law_index:
+            knowledge_base, kb_report = budget_context(
+                law_index, prompt, token_budget=LAW_TOKEN_BUDGET, counter=token_counter, header=DOC_HEADER)
+            print(f"Streamlit knowledge base: {format_report(kb_report)}", flush=True)
+        else:
+            knowledge_base = "ERROR: Folder 'laws' not found."
+
         system_instruction = f"""
         ТЫ — Виртуальный Юрист ALMA (Alma Zanger).
         ТВОЯ БАЗА ЗНАНИЙ:
@@ -215,28 +292,73 @@ if prompt := st.chat_input(prompt_text):
         2. ФОТО: Если загружено фото, сначала опиши нарушения, которые ты видишь (склоны, техника, деревья).
         3. АЛГОРИТМ: Если в Guidelines указан Сценарий А (Критическая угроза) — предложи обратиться в Земельную инспекцию (ДУЗР).
         4. Не выдумывай законы. Если информации нет — скажи честно.
+        5. ИСТОРИЯ: Если передана предыдущая переписка, учитывай ее — новый вопрос может быть уточнением.
         """
 
         # Подготовка контента для НОВОЙ версии API
-        contents_list = [system_instruction, prompt]
-        if pil_image:
-            contents_list.append(pil_image)
+        contents_list = [system_instruction, conversation, prompt] if conversation else [system_instruction, prompt]
+        if photo:
+            contents_list.append(types.Part.from_bytes(data=photo["jpeg"], mime_type="image/jpeg"))
 
+        # Потоковая генерация: текст появляется по мере готовности.
+        # Новое сообщение пользователя перезапускает скрипт — Streamlit прерывает цикл ниже,
+        # а finally сохраняет уже полученную часть ответа.
+        assistant_msg = {"role": "assistant", "content": ""}
+        chunks = []
+        first_token = None
+        finished = False
         try:
-            # Генерация (НОВЫЙ синтаксис)
-            response = client.models.generate_content(
-                model=active_model_name,
-                contents=contents_list,
-                config=types.GenerateContentConfig(
-                    temperature=0.0,
-                    max_output_tokens=8000
-                )
-            )
-            full_response = response.text
+            if cached_answer:
+                first_token = time.perf_counter() - started
+                chunks.append(cached_answer)
+            else:
+                # Первый вопрос без фото хранится в кэше ответов; остальное — в кэше точных запросов
+                for piece in cached_generate_stream(
+                    client, None if answer_key else gen_cache, model_name, contents_list,
+                    config=types.GenerateContentConfig(
+                        temperature=0.0,
+                        max_output_tokens=8000,
+                        cached_content=cache_name
+                    ),
+                    image_hashes=[photo["hash"]] if photo else []
+                ):
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    chunks.append(piece)
+                    placeholder.markdown("".join(chunks) + " ▌")
+                model_selector.report_success(model_name)
+            finished = True
+            full_response = "".join(chunks)
             placeholder.markdown(full_response)
+            if answer_key and not cached_answer:
+                answer_cache.put(answer_key, model_name, full_response)
         except Exception as e:
+            finished = True
+            model_selector.report_failure(model_name)
+            if cache_name:
+                context_cache.invalidate()
             err_msg = f"Ошибка связи с AI: {e}"
             placeholder.error(err_msg)
             full_response = err_msg
+            assistant_msg["skip_memory"] = True
+        finally:
+            total = time.perf_counter() - started
+            if not finished:
+                full_response = "".join(chunks) + " …[остановлено]"
+            ttft = f"{first_token:.1f} с" if first_token is not None else "—"
+            assistant_msg["content"] = full_response
+            assistant_msg["timing"] = f"⏱ первый фрагмент: {ttft}, весь ответ: {total:.1f} с"
+            if cached_answer:
+                assistant_msg["timing"] += " (из кэша)"
+            lookups = answer_cache.hits + answer_cache.misses
+            hit_rate = f"{answer_cache.hits}/{lookups}" if lookups else "—"
+            print(f"Streamlit answer: ttft={ttft}, total={total:.2f}s, finished={finished}, model={model_name}, "
+                  f"cached={bool(cached_answer)}, answer cache hits={hit_rate}", flush=True)
+            st.session_state.messages.append(assistant_msg)
+            memory.trim(st.session_state.messages)
+
+        st.caption(assistant_msg["timing"])
 
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
+    # Старые реплики сворачиваются моделью уже после ответа, а не перед ним
+    memory.compact(st.session_state.messages, summarize=summarize_turns)
+    memory.trim(st.session_state.messages)
@@ -0,0 +1,133 @@
+"""Пакетная генерация через Gemini Batch API для больших очередей дел.
+Все запросы RU/KZ уходят одним или несколькими пакетными заданиями; имена заданий и порядок
+ключей хранятся на диске, следующие запуски опрашивают задания и забирают готовые тексты."""
+import os
+import json
+import time
+
+from google.genai import types
+
+from metrics import METRICS, count
+
+BATCH_MAX_BYTES = 15 * 1024 * 1024    # Лимит inline-запросов одного задания (API — 20 МБ)
+BATCH_MAX_AGE_HOURS = 48              # Задание дольше этого считаем потерянным
+
+DONE_STATES = {"JOB_STATE_SUCCEEDED"}
+FAILED_STATES = {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+def request_size(contents):
+    size = 0
+    for c in contents:
+        if isinstance(c, str):
+            size += len(c.encode("utf-8"))
+        else:
+            data = getattr(getattr(c, "inline_data", None), "data", None)
+            size += len(data) if data else 0
+    return size
+
+
+def state_name(job):
+    state = getattr(job, "state", None)
+    return getattr(state, "name", None) or str(state)
+
+
+class BatchManager:
+    def __init__(self, state_path, max_bytes=BATCH_MAX_BYTES):
+        self.state_path = state_path
+        self.max_bytes = max_bytes
+        self.jobs = self._load_state()   # [{"name", "model", "keys", "submitted"}]
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("jobs", [])
+        except Exception:
+            return []
+
+    def _save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"jobs": self.jobs}, f, ensure_ascii=False)
+        os.replace(tmp, self.state_path)
+
+    def pending_keys(self):
+        return {key for job in self.jobs for key in job["keys"]}
+
+    def submit(self, client, model, requests, config=None):
+        """requests: [(key, contents)] — contents как для generate_content (текст + types.Part).
+        Делит запросы на задания по BATCH_MAX_BYTES; возвращает ключи, которые удалось отправить."""
+        groups, current, size = [], [], 0
+        for key, contents in requests:
+            req_size = request_size(contents)
+            if current and size + req_size > self.max_bytes:
+                groups.append(current)
+                current, size = [], 0
+            current.append((key, contents))
+            size += req_size
+        if current:
+            groups.append(current)
+
+        submitted = []
+        for group in groups:
+            src = [
+                types.InlinedRequest(
+                    contents=[types.Content(role="user", parts=[
+                        types.Part.from_text(text=c) if isinstance(c, str) else c for c in contents
+                    ])],
+                    config=config,
+                )
+                for _, contents in group
+            ]
+            try:
+                job = client.batches.create(
+                    model=model, src=src,
+                    config=types.CreateBatchJobConfig(display_name=f"alma-{int(time.time())}-{len(self.jobs)}"),
+                )
+            except Exception as e:
+                print(f"   ❌ Пакетное задание не создано ({len(group)} запросов): {e}", flush=True)
+                continue
+            keys = [key for key, _ in group]
+            self.jobs.append({"name": job.name, "model": model, "keys": keys, "submitted": time.time()})
+            self._save_state()
+            submitted += keys
+            count("gemini.batch_jobs")
+            count("gemini.batch_requests", len(keys))
+            print(f"   📦 Пакетное задание {job.name}: {len(keys)} запросов", flush=True)
+        return submitted
+
+    def poll(self, client):
+        """Опрашивает задания: {key: текст} для завершившихся. Упавшие и потерянные задания
+        забываются — их дела вернутся к обычной генерации."""
+        results, keep = {}, []
+        for entry in self.jobs:
+            try:
+                job = client.batches.get(name=entry["name"])
+            except Exception as e:
+                print(f"   ⚠️ Пакетное задание {entry['name']} недоступно: {e}", flush=True)
+                if time.time() - entry["submitted"] < BATCH_MAX_AGE_HOURS * 3600:
+                    keep.append(entry)
+                continue
+
+            state = state_name(job)
+            if state in DONE_STATES:
+                responses = getattr(getattr(job, "dest", None), "inlined_responses", None) or []
+                ok = 0
+                for key, item in zip(entry["keys"], responses):
+                    text = getattr(getattr(item, "response", None), "text", None)
+                    if text and not getattr(item, "error", None):
+                        results[key] = text
+                        ok += 1
+                        METRICS.record_usage(getattr(item.response, "usage_metadata", None))
+                count("gemini.batch_results", ok)
+                print(f"   📦 Задание {entry['name']} готово: {ok} ответов, ошибок {len(entry['keys']) - ok}", flush=True)
+            elif state in FAILED_STATES or time.time() - entry["submitted"] > BATCH_MAX_AGE_HOURS * 3600:
+                print(f"   ❌ Задание {entry['name']}: {state} — дела вернутся к обычной генерации", flush=True)
+            else:
+                print(f"   ⏳ Задание {entry['name']}: {state}", flush=True)
+                keep.append(entry)
+
+        if keep != self.jobs:
+            self.jobs = keep
+            self._save_state()
+        return results
@@ -0,0 +1,472 @@
+"""Офлайн-бенчмарк робота (main.py) без секретов и сети.
+Генерирует синтетический проект Mergin (N инцидентов, M фото, K слоев садов), подменяет
+MerginClient, genai.Client, smtplib.SMTP_SSL и gspread локальными заглушками с настраиваемой
+задержкой и долей ошибок и прогоняет main() целиком. Печатает время, время по стадиям и пик памяти.
+
+    python benchmark.py --incidents 50,200 --layers 1,4 --polygons 2000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import functools
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Окружение для main.py: заглушки вместо секретов, без кэша генераций, квота не ограничивает
+os.environ.update({
+    "MERGIN_USER": "bench@example.org",
+    "MERGIN_PASS": "bench",
+    "GMAIL_APP_PASS": "bench",
+    "GEMINI_API_KEY": "bench",
+    "GOOGLE_CREDENTIALS_JSON": "{}",
+    "ALMA_NO_CACHE": "1",
+    "ALMA_GEMINI_RPM": "100000",
+    "ALMA_GEMINI_BUDGET": "1000000",
+})
+
+ALMATY = (76.95, 43.22)  # lon, lat
+AREA_DEG = 0.2
+
+
+# --- СИНТЕТИЧЕСКИЕ ДАННЫЕ ---
+
+def make_project(template_dir, n_incidents, n_photos, n_layers, n_polygons, photo_px, seed=42):
+    import geopandas as gpd
+    import PIL.Image
+    from shapely.geometry import Point, box
+
+    rnd = random.Random(seed)
+    os.makedirs(template_dir, exist_ok=True)
+
+    uids = [str(uuid.UUID(int=rnd.getrandbits(128))) for _ in range(n_incidents)]
+    points = [Point(ALMATY[0] + rnd.uniform(0, AREA_DEG), ALMATY[1] + rnd.uniform(0, AREA_DEG)) for _ in uids]
+    incidents = gpd.GeoDataFrame({
+        "unique-id": uids,
+        "incident_type": [rnd.choice(["Срезка склона", "Вырубка сада", "Мусор", "Стройка в водоохранной полосе"]) for _ in uids],
+        "description": ["Синтетическое описание нарушения для бенчмарка" for _ in uids],
+        "volunteer_email": ["volunteer@example.org" for _ in uids],
+        "layers": ["" for _ in uids],
+        "is_sent": [0 for _ in uids],
+    }, geometry=points, crs="EPSG:4326").to_crs("EPSG:3857")  # проект в метрах — робот пересчитывает в WGS84
+    incidents.to_file(os.path.join(template_dir, "Инцидент.gpkg"), layer="Инцидент", driver="GPKG")
+
+    photo_rows = []
+    for i in range(n_photos):
+        name = f"IMG_{i:05d}.jpg"
+        img = PIL.Image.new("RGB", photo_px, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        img.save(os.path.join(template_dir, name), quality=90)
+        photo_rows.append({"external_pk": uids[i % n_incidents] if uids else "", "photo": name})
+    photos = gpd.GeoDataFrame(photo_rows, geometry=[Point(*ALMATY)] * len(photo_rows), crs="EPSG:4326")
+    photos.to_file(os.path.join(template_dir, "photos.gpkg"), layer="photos", driver="GPKG")
+
+    side = max(1, int(n_polygons ** 0.5))
+    cell = AREA_DEG / side
+    for k in range(n_layers):
+        shift = cell * k / max(1, n_layers)
+        polys, ids = [], []
+        for i in range(side):
+            for j in range(side):
+                if rnd.random() < 0.5:  # половина сетки пустая — часть точек не попадет ни в один сад
+                    x0, y0 = ALMATY[0] + i * cell + shift, ALMATY[1] + j * cell
+                    polys.append(box(x0, y0, x0 + cell, y0 + cell))
+                    ids.append(f"20-321-{k:02d}-{i:04d}{j:04d}")
+        gardens = gpd.GeoDataFrame({"kadastr": ids}, geometry=polys, crs="EPSG:4326").to_crs("EPSG:32643")
+        gardens.to_file(os.path.join(template_dir, f"сады_{k}.gpkg"), driver="GPKG")
+
+
+# --- ЗАГЛУШКИ ВНЕШНИХ СЕРВИСОВ ---
+
+class FakeError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} fake error")
+        self.code = code
+
+
+class Faults:
+    """Задержка и доля ошибок для одной заглушки"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, codes=(503,), seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.codes = codes
+        self.calls = 0
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.calls += 1
+            fail = self._rnd.random() < self.error_rate
+            code = self._rnd.choice(self.codes)
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeError(code)
+
+
+class FakeMerginClient:
+    template_dir = None
+    version = "v1"
+    faults = Faults()
+
+    def __init__(self, url, login=None, password=None):
+        pass
+
+    def _mark(self, path):
+        os.makedirs(os.path.join(path, ".mergin"), exist_ok=True)
+        with open(os.path.join(path, ".mergin", "version.json"), "w") as f:
+            json.dump({"version": FakeMerginClient.version}, f)
+
+    def download_project(self, project, path):
+        self.faults.hit()
+        shutil.copytree(self.template_dir, path)
+        self._mark(path)
+
+    def pull_project(self, path):
+        self.faults.hit()
+        self._mark(path)
+
+    def push_project(self, path):
+        self.faults.hit()
+        FakeMerginClient.version = f"v{int(FakeMerginClient.version[1:]) + 1}"
+        self._mark(path)
+
+    def project_info(self, project):
+        return {"version": FakeMerginClient.version}
+
+
+class FakeMerginProject:
+    def __init__(self, path):
+        with open(os.path.join(path, ".mergin", "version.json")) as f:
+            self.metadata = json.load(f)
+
+    def version(self):
+        return self.metadata["version"]
+
+
+class FakeCaches:
+    """Кэш контекста: create/update/delete с TTL, как client.caches"""
+    store = {}   # имя -> {"model", "tokens", "expires"}
+    created = 0
+
+    def create(self, model, config):
+        name = f"cachedContents/fake-{uuid.uuid4().hex[:8]}"
+        text = (config.system_instruction or "") + "".join(c for c in config.contents if isinstance(c, str))
+        FakeCaches.store[name] = {"model": model, "tokens": len(text) // 4,
+                                  "expires": time.time() + int(config.ttl.rstrip("s"))}
+        FakeCaches.created += 1
+        return SimpleNamespace(name=name, model=model)
+
+    def update(self, name, config):
+        if name not in FakeCaches.store:
+            raise FakeError(404)
+        FakeCaches.store[name]["expires"] = time.time() + int(config.ttl.rstrip("s"))
+
+    def delete(self, name):
+        FakeCaches.store.pop(name, None)
+
+    @staticmethod
+    def lookup(name, model):
+        entry = FakeCaches.store.get(name)
+        if not entry or entry["expires"] < time.time() or entry["model"] != model:
+            raise FakeError(404)
+        return entry
+
+
+def fake_response(model, prompt, cached_tokens=0):
+    text = f"Сгенерированный текст ({model}): " + prompt[:200]
+    usage = SimpleNamespace(prompt_token_count=len(prompt) // 4 + cached_tokens, candidates_token_count=len(text) // 4,
+                            cached_content_token_count=cached_tokens,
+                            total_token_count=(len(prompt) + len(text)) // 4 + cached_tokens)
+    return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+class FakeModels:
+    faults = Faults()
+
+    def generate_content(self, model, contents, config=None):
+        self.faults.hit()
+        prompt = contents if isinstance(contents, str) else "\n".join(c for c in contents if isinstance(c, str))
+        cached = getattr(config, "cached_content", None)
+        cached_tokens = FakeCaches.lookup(cached, model)["tokens"] if cached else 0
+        return fake_response(model, prompt, cached_tokens)
+
+    def count_tokens(self, model, contents):
+        text = contents if isinstance(contents, str) else "".join(c for c in contents if isinstance(c, str))
+        return SimpleNamespace(total_tokens=len(text) // 3)
+
+
+class FakeBatches:
+    """Batch API: задание выполняется сразу, но получает SUCCEEDED только после polls_to_finish опросов"""
+    jobs = {}
+    polls_to_finish = 1
+
+    def create(self, model, src, config=None):
+        name = f"batches/fake-{uuid.uuid4().hex[:8]}"
+        responses = []
+        for req in src:
+            prompt = "\n".join(p.text for c in req.contents for p in c.parts if getattr(p, "text", None))
+            responses.append(SimpleNamespace(response=fake_response(model, prompt), error=None))
+        FakeBatches.jobs[name] = {"polls": 0, "responses": responses}
+        return SimpleNamespace(name=name)
+
+    def get(self, name):
+        job = FakeBatches.jobs.get(name)
+        if job is None:
+            raise FakeError(404)
+        job["polls"] += 1
+        done = job["polls"] >= self.polls_to_finish
+        state = "JOB_STATE_SUCCEEDED" if done else "JOB_STATE_RUNNING"
+        dest = SimpleNamespace(inlined_responses=job["responses"]) if done else None
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), dest=dest)
+
+
+class FakeGenaiClient:
+    def __init__(self, api_key=None):
+        self.models = FakeModels()
+        self.caches = FakeCaches()
+        self.batches = FakeBatches()
+
+
+class FakeSMTP:
+    faults = Faults()
+    logins = 0
+    sent = 0
+
+    def __init__(self, host, port):
+        pass
+
+    def login(self, user, password):
+        self.faults.hit()
+        FakeSMTP.logins += 1
+
+    def send_message(self, msg):
+        self.faults.hit()
+        msg.as_bytes()  # полная сериализация, как при реальной отправке
+        FakeSMTP.sent += 1
+
+    def quit(self):
+        pass
+
+    close = quit
+
+
+class FakeSheet:
+    faults = Faults()
+    rows = []
+
+    def acell(self, label):
+        self.faults.hit()
+        return SimpleNamespace(value=self.rows[0][0] if self.rows else None)
+
+    def append_row(self, row):
+        self.faults.hit()
+        self.rows.append(row)
+
+    def append_rows(self, rows):
+        self.faults.hit()
+        self.rows.extend(rows)
+
+
+def fake_authorize(creds):
+    return SimpleNamespace(open=lambda name: SimpleNamespace(sheet1=FakeSheet()))
+
+
+# --- ИЗМЕРЕНИЯ ---
+
+STAGES = [
+    "sync_working_copy", "read_pending_incidents", "read_photo_index", "load_garden_layers",
+    "find_garden_cadastres", "prepare_incident_photos", "archive_incident_photos", "generate_text",
+    "deliver_incident", "update_gpkg_rows", "sync_project_safely",
+]
+
+
+class StageTimer:
+    """Суммарное время по стадиям (для стадий в пулах потоков — сумма по всем вызовам)"""
+
+    def __init__(self):
+        self.totals = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - t0
+                    self.calls[name] = self.calls.get(name, 0) + 1
+        return timed
+
+
+def install_fakes(robot, args):
+    FakeModels.faults = Faults(args.gen_latency, args.gen_error_rate, codes=(429, 503), seed=1)
+    FakeSMTP.faults = Faults(args.smtp_latency, args.smtp_error_rate, seed=2)
+    FakeSheet.faults = Faults(args.sheets_latency, 0.0, seed=3)
+    FakeMerginClient.faults = Faults(args.mergin_latency, 0.0, seed=4)
+    FakeSMTP.logins = FakeSMTP.sent = 0
+    FakeSheet.rows = []
+    FakeCaches.store, FakeCaches.created = {}, 0
+    FakeBatches.jobs = {}
+    robot.CONTEXT_CACHE = args.context_cache
+    robot.BATCH_THRESHOLD = args.batch_threshold
+
+    robot.MerginClient = FakeMerginClient
+    robot.MerginProject = FakeMerginProject
+    robot.genai = SimpleNamespace(Client=FakeGenaiClient)
+    robot.smtplib = SimpleNamespace(SMTP_SSL=FakeSMTP)
+    robot.gspread = SimpleNamespace(authorize=fake_authorize)
+    robot.ServiceAccountCredentials = SimpleNamespace(from_json_keyfile_name=lambda path, scope: None)
+
+
+def run_case(robot, args, n, k, workdir):
+    case_dir = os.path.join(workdir, f"case_n{n}_k{k}")
+    template = os.path.join(case_dir, "template")
+    run_dir = os.path.join(case_dir, "run")
+    os.makedirs(os.path.join(run_dir, robot.ARCHIVE_PATH, "PHOTOS"), exist_ok=True)
+    # Настоящая база законов: без нее поиск, бюджет и размер промпта не измеряются
+    os.symlink(os.path.join(REPO_DIR, "laws"), os.path.join(run_dir, "laws"))
+    # Модель уже выбрана: "Ping" без повторов не должен попадать под --gen-error-rate,
+    # иначе при заметной доле ошибок прогон обрывается до генерации
+    with open(os.path.join(run_dir, robot.MODEL_STATE_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model": robot.MODEL_CANDIDATES[0], "checked": time.time()}, f)
+
+    t0 = time.perf_counter()
+    make_project(template, n, n * args.photos_per_incident, k, args.polygons, (args.photo_width, args.photo_height))
+    gen_time = time.perf_counter() - t0
+
+    install_fakes(robot, args)
+    FakeMerginClient.template_dir = template
+    FakeMerginClient.version = "v1"
+
+    timer = StageTimer()
+    originals = {name: getattr(robot, name) for name in STAGES}
+    for name, fn in originals.items():
+        setattr(robot, name, timer.wrap(name, fn))
+
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        statuses = [robot.main()]
+        if args.batch_threshold:
+            statuses.append(robot.main())  # второй запуск забирает результаты пакетного задания и рассылает письма
+    finally:
+        wall = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        os.chdir(cwd)
+        for name, fn in originals.items():
+            setattr(robot, name, fn)
+
+    return {
+        "incidents": n,
+        "layers": k,
+        "polygons_per_layer": args.polygons,
+        "photos": n * args.photos_per_incident,
+        "setup_s": round(gen_time, 3),
+        "wall_s": round(wall, 3),
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "gemini_calls": FakeModels.faults.calls,
+        "smtp_logins": FakeSMTP.logins,
+        "emails": FakeSMTP.sent,
+        "sheet_rows": len(FakeSheet.rows),
+        "context_caches": FakeCaches.created,
+        "stages_s": {name: round(t, 3) for name, t in timer.totals.items()},
+        "metrics": robot.METRICS.snapshot(),
+        "statuses": statuses,
+    }
+
+
+def case_errors(result):
+    """Причины считать прогон неудачным: статус "error" или ошибки стадий в метриках"""
+    errors = [f"статус {s}" for s in result["statuses"] if s == "error"]
+    failed = result["metrics"]["counters"].get("pipeline.errors", 0)
+    if failed:
+        errors.append(f"ошибок стадий: {failed}")
+    return errors
+
+
+def print_table(results):
+    cols = ["incidents", "layers", "photos", "wall_s", "peak_mb", "gemini_calls", "smtp_logins", "emails"]
+    print("\n" + " | ".join(f"{c:>12}" for c in cols))
+    for r in results:
+        print(" | ".join(f"{r[c]:>12}" for c in cols))
+    print("\nСтадии (суммарно по потокам, с):")
+    for r in results:
+        stages = ", ".join(f"{k}={v}" for k, v in sorted(r["stages_s"].items(), key=lambda x: -x[1]))
+        print(f"  N={r['incidents']} K={r['layers']}: {stages}")
+
+
+def int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк main.py на синтетических данных")
+    parser.add_argument("--incidents", type=int_list, default=[20, 100], help="N через запятую")
+    parser.add_argument("--layers", type=int_list, default=[1, 4], help="K слоев садов через запятую")
+    parser.add_argument("--polygons", type=int, default=2000, help="полигонов в каждом слое")
+    parser.add_argument("--photos-per-incident", type=int, default=1)
+    parser.add_argument("--photo-width", type=int, default=2000)
+    parser.add_argument("--photo-height", type=int, default=1500)
+    parser.add_argument("--gen-latency", type=float, default=0.2, help="задержка Gemini, с")
+    parser.add_argument("--gen-error-rate", type=float, default=0.0, help="доля ошибок 429/503 от Gemini")
+    parser.add_argument("--smtp-latency", type=float, default=0.05)
+    parser.add_argument("--smtp-error-rate", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.1)
+    parser.add_argument("--mergin-latency", type=float, default=0.0)
+    parser.add_argument("--context-cache", action="store_true", help="база законов через кэш контекста")
+    parser.add_argument("--batch-threshold", type=int, default=0,
+                        help="пакетная генерация от стольких запросов (0 — выключена); прогон тогда в два запуска")
+    parser.add_argument("--json", help="записать результаты в JSON-файл")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="alma_bench_")
+    # main.py при импорте создает ALMA_ARCHIVE в текущей папке — импортируем его из временной
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import main as robot
+    finally:
+        os.chdir(cwd)
+
+    results = []
+    try:
+        for n in args.incidents:
+            for k in args.layers:
+                print(f"\n===== N={n} K={k} =====", flush=True)
+                results.append(run_case(robot, args, n, k, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = [(r, case_errors(r)) for r in results if case_errors(r)]
+    for r, errors in failed:
+        print(f"❌ N={r['incidents']} K={r['layers']}: {', '.join(errors)}", flush=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
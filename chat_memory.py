@@ -0,0 +1,83 @@
+"""Память диалога консультанта: в модель идет окно последних реплик в пределах бюджета токенов,
+более старые реплики сворачиваются в краткое содержание. Хранимая история тоже ограничена."""
+from kb_budget import TokenCounter
+
+HISTORY_TOKEN_BUDGET = 3000   # Токенов на последние реплики в каждом запросе
+SUMMARY_MAX_CHARS = 2000      # Длина краткого содержания старой части диалога
+MAX_KEPT_MESSAGES = 60        # Сколько сообщений держать в сессии (свернутые старые удаляются)
+SNIPPET_CHARS = 300           # Сколько символов реплики идет в запасное краткое содержание
+
+ROLE_NAMES = {"user": "Пользователь", "assistant": "Юрист"}
+
+
+def format_turn(msg):
+    text = msg["content"]
+    if msg.get("image_hash"):
+        text = f"[фото {msg['image_hash'][:8]}] " + text
+    return f"{ROLE_NAMES.get(msg['role'], msg['role'])}: {text}"
+
+
+def fallback_summary(summary, turns, max_chars=SUMMARY_MAX_CHARS):
+    """Краткое содержание без модели: начало каждой реплики, самые старые обрезаются первыми"""
+    lines = [summary] if summary else []
+    lines += [format_turn(m)[:SNIPPET_CHARS] for m in turns]
+    return "\n".join(lines)[-max_chars:]
+
+
+class ChatMemory:
+    def __init__(self, budget=HISTORY_TOKEN_BUDGET, max_kept=MAX_KEPT_MESSAGES, counter=None):
+        self.budget = budget
+        self.counter = counter or TokenCounter()
+        self.max_kept = max_kept
+        self.summary = ""
+        self.summarized = 0   # Сколько первых сообщений уже свернуто в summary
+
+    def window(self, history):
+        """Делит несвернутую часть истории: (старое, окно последних реплик в пределах бюджета,
+        индекс в history, с которого начинается окно)"""
+        used, start = 0, len(history)
+        for i in range(len(history) - 1, self.summarized - 1, -1):
+            if history[i].get("skip_memory"):
+                continue
+            cost = self.counter.count(format_turn(history[i]))
+            if used + cost > self.budget:
+                break
+            used += cost
+            start = i
+        keep = lambda msgs: [m for m in msgs if not m.get("skip_memory")]
+        return keep(history[self.summarized:start]), keep(history[start:]), start
+
+    def context(self, history):
+        """Текст истории для промпта (history — сообщения до текущего вопроса), без вызова модели:
+        старые реплики, которые compact() еще не свернул, идут началами реплик."""
+        older, recent, _ = self.window(history)
+        summary = fallback_summary(self.summary, older) if older else self.summary
+
+        parts = []
+        if summary:
+            parts.append("КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО РАЗГОВОРА:\n" + summary)
+        if recent:
+            parts.append("ПОСЛЕДНИЕ СООБЩЕНИЯ:\n" + "\n".join(format_turn(m) for m in recent))
+        return "\n\n".join(parts)
+
+    def compact(self, history, summarize=None):
+        """Сворачивает в краткое содержание реплики, вышедшие из окна. Вызывается после ответа,
+        чтобы вызов модели не задерживал первый фрагмент.
+        summarize(summary, turns) -> новое краткое содержание; если не передан или упал — без модели."""
+        older, _, start = self.window(history)
+        if not older:
+            return
+        try:
+            self.summary = summarize(self.summary, older) if summarize else fallback_summary(self.summary, older)
+        except Exception as e:
+            print(f"Chat memory: summary failed ({e}), using snippets", flush=True)
+            self.summary = fallback_summary(self.summary, older)
+        self.summary = self.summary[-SUMMARY_MAX_CHARS:]
+        self.summarized = start
+
+    def trim(self, messages):
+        """Удаляет из сессии самые старые уже свернутые сообщения сверх лимита"""
+        extra = min(len(messages) - self.max_kept, self.summarized)
+        if extra > 0:
+            del messages[:extra]
+            self.summarized -= extra
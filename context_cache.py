@@ -0,0 +1,115 @@
+"""Кэш контекста на стороне Gemini: полная база законов и руководство загружаются один раз
+как cached content с TTL, запросы ссылаются на него по имени вместо повторной отправки текста.
+Кэш пересоздается, когда меняется содержимое базы (хэш law_corpus, не время файлов) или модель; если API кэша недоступен — None,
+и вызывающий код подставляет текст в промпт как раньше."""
+import os
+import json
+import time
+import threading
+
+from google.genai import types
+
+from metrics import count
+
+CONTEXT_CACHE_TTL = 3600          # Секунды жизни кэша на сервере
+REFRESH_MARGIN = 300              # Продлеваем TTL, если до конца осталось меньше
+RETRY_AFTER_FAILURE = 600         # После ошибки API не пытаемся создать кэш столько секунд
+
+# Фраза для промпта вместо текста базы, когда база уже в кэше контекста
+CACHED_CORPUS_NOTE = "(Полный текст законов и руководства уже загружен в контекст этого запроса.)"
+
+
+class ContextCacheManager:
+    def __init__(self, client, corpus, build_corpus, state_path=None, ttl=CONTEXT_CACHE_TTL, enabled=True):
+        """corpus — law_corpus.CorpusLoader (версия кэша — хэш содержимого базы, одинаковый после
+        нового checkout); build_corpus() -> (system_instruction, текст базы) — только при (пере)создании кэша"""
+        self.client = client
+        self.corpus = corpus
+        self.build_corpus = build_corpus
+        self.state_path = state_path
+        self.ttl = ttl
+        self.enabled = enabled
+        self.state = self._load_state()
+        self.failed_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        try:
+            if os.path.dirname(self.state_path):
+                os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+        except Exception as e:
+            print(f"   ⚠️ Состояние кэша контекста не сохранено: {e}", flush=True)
+
+    def get(self, model):
+        """Имя cached content для модели или None (тогда база идет в промпт текстом)"""
+        if not self.enabled or time.time() - self.failed_at < RETRY_AFTER_FAILURE:
+            return None
+        with self._lock:
+            try:
+                return self._ensure(model)
+            except Exception as e:
+                self.failed_at = time.time()
+                count("context_cache.errors")
+                print(f"   ⚠️ Кэш контекста недоступен ({e}), база пойдет текстом в промпт.", flush=True)
+                return None
+
+    def _ensure(self, model):
+        version = self.corpus.version
+        now = time.time()
+        state = self.state
+        if state.get("name") and state.get("model") == model and state.get("version") == version:
+            if state.get("expires", 0) - now > REFRESH_MARGIN:
+                return state["name"]
+            if state.get("expires", 0) > now:
+                self.client.caches.update(
+                    name=state["name"], config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+                state["expires"] = now + self.ttl
+                self._save_state()
+                count("context_cache.refreshed")
+                return state["name"]
+
+        # Базы изменились, сменилась модель или кэш истек — создаем заново
+        self._delete_current()
+        system_instruction, corpus = self.build_corpus()
+        cached = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                display_name=f"alma-laws-{version}",
+                system_instruction=system_instruction,
+                contents=[corpus],
+                ttl=f"{self.ttl}s",
+            ),
+        )
+        count("context_cache.created")
+        self.state = {"name": cached.name, "model": model, "version": version, "expires": now + self.ttl}
+        self._save_state()
+        print(f"   🧠 Кэш контекста создан: {cached.name} (база {version})", flush=True)
+        return cached.name
+
+    def invalidate(self):
+        """Запрос с кэшем не прошел (кэш удален или истек на сервере) — следующий get() создаст новый"""
+        with self._lock:
+            self.state = {}
+            self._save_state()
+
+    def _delete_current(self):
+        name = self.state.get("name")
+        if not name or self.state.get("expires", 0) < time.time():
+            return
+        try:
+            self.client.caches.delete(name=name)
+        except Exception:
+            pass
@@ -0,0 +1,46 @@
+"""Склейка повторных сообщений об одном нарушении: точки одного типа и одного кадастра,
+ближе max_distance метров и max_minutes минут друг к другу, становятся одним делом.
+Сообщение входит в группу, только если оно в пределах обоих лимитов от каждого ее сообщения,
+поэтому цепочка точек через 40 м не растягивает группу дальше max_distance.
+Соседей ищем по сетке с ячейкой max_distance (проверяются только 9 соседних ячеек)."""
+import math
+
+
+def _close(a, b, max_distance, max_minutes):
+    if math.hypot(a["x"] - b["x"], a["y"] - b["y"]) > max_distance:
+        return False
+    if max_minutes and a["time"] is not None and b["time"] is not None:
+        if abs((a["time"] - b["time"]).total_seconds()) > max_minutes * 60:
+            return False
+    return True
+
+
+def cluster_incidents(items, max_distance, max_minutes=None):
+    """items: [{"key", "x", "y" (метры), "time" (datetime или None), "group" (тип, кадастр)}] в порядке поступления.
+    Возвращает список групп ключей; первый ключ группы — самое раннее сообщение.
+    Сообщение добавляется в самую раннюю группу, со всеми сообщениями которой оно совпадает.
+    Если у одного из двух сообщений нет времени, окно по времени между ними не проверяется."""
+    if not items or not max_distance:
+        return [[item["key"]] for item in items]
+
+    clusters = []   # [[индексы items]]
+    grid = {}       # ячейка -> индексы групп, у которых в ней есть сообщения
+    for i, item in enumerate(items):
+        cx, cy = math.floor(item["x"] / max_distance), math.floor(item["y"] / max_distance)
+        candidates = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates.update(grid.get((item["group"], cx + dx, cy + dy), ()))
+
+        target = None
+        for c in sorted(candidates):
+            if all(_close(item, items[j], max_distance, max_minutes) for j in clusters[c]):
+                target = c
+                break
+        if target is None:
+            target = len(clusters)
+            clusters.append([])
+        clusters[target].append(i)
+        grid.setdefault((item["group"], cx, cy), set()).add(target)
+
+    return [[items[i]["key"] for i in members] for members in clusters]
@@ -0,0 +1,207 @@
+"""Дисковый кэш ответов Gemini (SQLite).
+Ключ: модель + хэш промпта + хэши фото + настройки генерации. При temperature=0.0 повторный ответ не нужен."""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from rate_limit import call_with_retry
+from metrics import METRICS
+
+CACHE_PATH = os.environ.get("ALMA_CACHE_PATH", "gen_cache.sqlite")
+CACHE_MAX_MB = 200
+CACHE_MAX_AGE_DAYS = 30
+EVICT_EVERY = 50  # Чистка после каждых N записей
+
+# ALMA_NO_CACHE=1 — работать без кэша (всегда спрашивать модель)
+CACHE_DISABLED = os.environ.get("ALMA_NO_CACHE", "").strip() not in ("", "0")
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def config_fingerprint(config):
+    """Стабильное представление GenerateContentConfig для ключа"""
+    if config is None:
+        return ""
+    if hasattr(config, "model_dump"):
+        return json.dumps(config.model_dump(exclude_none=True, mode="json"), sort_keys=True, ensure_ascii=False)
+    if isinstance(config, dict):
+        return json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return repr(config)
+
+
+def normalize_question(text):
+    """Вопрос без регистра, пунктуации и лишних пробелов: "Куда жаловаться?" == "куда  жаловаться" """
+    text = (text or "").lower().replace("ё", "е")
+    return " ".join(re.findall(r"\w+", text))
+
+
+class GenerationCache:
+    def __init__(self, path=CACHE_PATH, max_mb=CACHE_MAX_MB, max_age_days=CACHE_MAX_AGE_DAYS, enabled=None):
+        self.enabled = (not CACHE_DISABLED) if enabled is None else enabled
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if not self.enabled:
+            return
+        try:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS generations (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created REAL,
+                    last_used REAL
+                )""")
+            self._db.commit()
+            self.evict()
+        except Exception as e:
+            print(f"   ⚠️ Кэш генераций недоступен ({e}), работаю без него.", flush=True)
+            self._db = None
+            self.enabled = False
+
+    @staticmethod
+    def make_key(model, prompt, image_hashes=(), config=None):
+        parts = [model, hash_bytes(prompt.encode("utf-8")), ",".join(image_hashes), config_fingerprint(config)]
+        return hash_bytes("\n".join(parts).encode("utf-8"))
+
+    @staticmethod
+    def make_answer_key(lang, corpus_version, question):
+        """Ключ готового ответа консультанта: нормализованный вопрос + язык + версия базы законов"""
+        return hash_bytes("\n".join(["answer", lang, corpus_version, normalize_question(question)]).encode("utf-8"))
+
+    def get(self, key):
+        if not self._db:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT response, created FROM generations WHERE key = ?", (key,)).fetchone()
+            if row and time.time() - row[1] <= self.max_age:
+                self._db.execute("UPDATE generations SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, model, response):
+        if not self._db or not response:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO generations (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now))
+            self._db.commit()
+            self._puts += 1
+        if self._puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Удаляет устаревшие записи, затем самые давно использованные, пока кэш не влезет в лимит"""
+        if not self._db:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM generations WHERE created < ?", (time.time() - self.max_age,))
+            total = 0
+            stale = []
+            for key, size in self._db.execute("SELECT key, size FROM generations ORDER BY last_used DESC"):
+                total += size
+                if total > self.max_bytes:
+                    stale.append((key,))
+            if stale:
+                self._db.executemany("DELETE FROM generations WHERE key = ?", stale)
+            self._db.commit()
+
+    def close(self):
+        if self._db:
+            with self._lock:
+                self._db.close()
+            self._db = None
+
+
+def content_size(part):
+    """Сколько байт уходит в модель: текст или inline-картинка (types.Part)"""
+    if isinstance(part, str):
+        return len(part.encode("utf-8"))
+    data = getattr(getattr(part, "inline_data", None), "data", None)
+    return len(data) if data else 0
+
+
+def cached_generate(client, cache, model, contents, config=None, image_hashes=(), limiter=None):
+    """generate_content с кэшем. contents[0] — текст промпта, дальше картинки (их хэши в image_hashes).
+    Если передан limiter (rate_limit.RateLimiter), запрос идет через него с повторами; попадание в кэш квоту не тратит.
+    Возвращает текст ответа."""
+    key = None
+    if cache and cache.enabled:
+        key = cache.make_key(model, "\n".join(c for c in contents if isinstance(c, str)), image_hashes, config)
+        hit = cache.get(key)
+        if hit is not None:
+            METRICS.count("gemini.cache_hits")
+            return hit
+
+    upload_bytes = sum(content_size(c) for c in contents)
+
+    def call():
+        METRICS.count("gemini.calls")
+        METRICS.count("gemini.upload_bytes", upload_bytes)
+        resp = client.models.generate_content(model=model, contents=contents, config=config)
+        METRICS.record_usage(getattr(resp, "usage_metadata", None))
+        METRICS.count("gemini.download_bytes", len((resp.text or "").encode("utf-8")))
+        if not resp.text:
+            raise ValueError("пустой ответ модели")
+        return resp.text
+
+    text = call_with_retry(call, limiter) if limiter else call()
+    if key:
+        cache.put(key, model, text)
+    return text
+
+
+def cached_generate_stream(client, cache, model, contents, config=None, image_hashes=()):
+    """Потоковая версия cached_generate: отдает куски текста по мере генерации.
+    При попадании в кэш — весь ответ одним куском. В кэш попадает только полностью полученный ответ:
+    если потребитель остановил генератор (пользователь прервал ответ), ничего не сохраняется."""
+    key = None
+    if cache and cache.enabled:
+        key = cache.make_key(model, "\n".join(c for c in contents if isinstance(c, str)), image_hashes, config)
+        hit = cache.get(key)
+        if hit is not None:
+            METRICS.count("gemini.cache_hits")
+            yield hit
+            return
+
+    METRICS.count("gemini.calls")
+    METRICS.count("gemini.upload_bytes", sum(content_size(c) for c in contents))
+    stream = client.models.generate_content_stream(model=model, contents=contents, config=config)
+    parts, usage = [], None
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+    METRICS.record_usage(usage)
+    text = "".join(parts)
+    METRICS.count("gemini.download_bytes", len(text.encode("utf-8")))
+    if not text:
+        raise ValueError("пустой ответ модели")
+    if key:
+        cache.put(key, model, text)
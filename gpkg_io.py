@@ -0,0 +1,139 @@
+"""Точечная работа с GeoPackage.
+Чтение: фильтр и выбор колонок выполняет сам GDAL (pyogrio), в память попадают только нужные строки.
+Запись: обновляем только нужные строки через SQLite, не переписывая файл.
+Геометрия, fid и нетронутые строки остаются как были — Mergin видит маленький changeset."""
+import struct
+import sqlite3
+
+import pyogrio
+import shapely
+
+ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}  # Байт конверта по индикатору во флагах заголовка
+
+
+def gpkg_header(blob):
+    """(пустая ли геометрия, (minx, maxx, miny, maxy) или None, смещение WKB) из заголовка GPKG blob"""
+    flags = blob[3]
+    envelope_size = ENVELOPE_SIZES.get((flags >> 1) & 0x07, 0)
+    envelope = None
+    if envelope_size:
+        envelope = struct.unpack(("<" if flags & 0x01 else ">") + "4d", blob[8:40])
+    return bool(flags & 0x10), envelope, 8 + envelope_size
+
+
+def gpkg_bounds(blob):
+    empty, envelope, offset = gpkg_header(blob)
+    if empty:
+        return None
+    if envelope:
+        return envelope
+    minx, miny, maxx, maxy = shapely.from_wkb(bytes(blob[offset:])).bounds
+    return minx, maxx, miny, maxy
+
+
+def _bound(i):
+    def fn(blob):
+        if blob is None:
+            return None
+        bounds = gpkg_bounds(blob)
+        return bounds[i] if bounds else None
+    return fn
+
+
+def register_spatial_functions(conn):
+    """Функции из триггеров rtree-индекса GDAL/QGIS (ST_IsEmpty, ST_MinX...). Без них любой
+    UPDATE таблицы слоя через sqlite3 падает с "no such function: ST_IsEmpty"."""
+    conn.create_function("ST_IsEmpty", 1, lambda blob: None if blob is None else int(gpkg_header(blob)[0]),
+                         deterministic=True)
+    for i, name in enumerate(["ST_MinX", "ST_MaxX", "ST_MinY", "ST_MaxY"]):
+        conn.create_function(name, 1, _bound(i), deterministic=True)
+
+
+def feature_table(conn, layer=None):
+    """Имя таблицы слоя: указанный layer или первый слой с объектами из gpkg_contents"""
+    if layer:
+        return layer
+    row = conn.execute(
+        "SELECT table_name FROM gpkg_contents WHERE data_type = 'features' ORDER BY rowid LIMIT 1").fetchone()
+    if not row:
+        raise ValueError("в GeoPackage нет слоев с объектами")
+    return row[0]
+
+
+def table_columns(conn, table):
+    """{имя колонки: тип}, плюс имя первичного ключа (fid)"""
+    columns, pk = {}, None
+    for _, name, col_type, _, _, is_pk in conn.execute(f'PRAGMA table_info("{table}")'):
+        columns[name] = col_type
+        if is_pk:
+            pk = name
+    return columns, pk
+
+
+def sql_type(value):
+    if isinstance(value, bool) or isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+
+def update_gpkg_rows(path, updates, layer=None):
+    """updates: {fid: {колонка: значение}}. Недостающие колонки добавляются через ALTER TABLE.
+    Возвращает число обновленных строк."""
+    if not updates:
+        return 0
+    conn = sqlite3.connect(path)
+    register_spatial_functions(conn)
+    try:
+        table = feature_table(conn, layer)
+        columns, pk = table_columns(conn, table)
+        pk = pk or "fid"
+
+        new_columns = {}
+        for values in updates.values():
+            for col, val in values.items():
+                if col not in columns and col not in new_columns:
+                    new_columns[col] = sql_type(val)
+        for col, col_type in new_columns.items():
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}" {col_type}')
+
+        changed = 0
+        for fid, values in updates.items():
+            cols = list(values)
+            assignments = ", ".join(f'"{c}" = ?' for c in cols)
+            cur = conn.execute(
+                f'UPDATE "{table}" SET {assignments} WHERE "{pk}" = ?',
+                [values[c] for c in cols] + [int(fid)])
+            changed += cur.rowcount
+
+        conn.execute(
+            "UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+            (table,))
+        conn.commit()
+        return changed
+    finally:
+        conn.close()
+
+
+def layer_fields(path):
+    return list(pyogrio.read_info(path)["fields"])
+
+
+def read_pending_incidents(path, columns):
+    """Только необработанные инциденты (is_sent = 0 или пусто) и только нужные колонки; индекс — fid"""
+    fields = layer_fields(path)
+    selected = [c for c in columns if c in fields]
+    where = '"is_sent" = 0 OR "is_sent" IS NULL' if "is_sent" in fields else None
+    return pyogrio.read_dataframe(path, columns=selected, where=where, fid_as_index=True)
+
+
+def read_photo_index(path, key_column="external_pk", photo_column="photo"):
+    """Один проход по таблице фото: {external_pk: [пути к фото]}, без геометрии"""
+    df = pyogrio.read_dataframe(path, columns=[key_column, photo_column], read_geometry=False)
+    index = {}
+    for key, photo in zip(df[key_column], df[photo_column]):
+        if key is None or not photo:
+            continue
+        index.setdefault(str(key), []).append(photo)
+    return index
@@ -0,0 +1,99 @@
+"""Журнал обработки дел (SQLite, пишется сразу после каждого шага).
+Шаги: generated_RU / generated_KZ (текст), emailed[_RU|_KZ], logged, committed.
+Прерванный запуск продолжается с последнего шага: готовые тексты не генерируются заново,
+отправленные письма и строки реестра не повторяются, а несохраненные в GPKG дела дописываются."""
+import json
+import time
+import sqlite3
+import threading
+
+STARTED = "started"          # {"fid", "cad_id"} — для дозаписи в GPKG
+LOGGED = "logged"
+COMMITTED = "committed"
+KEEP_DAYS = 30               # Сколько хранить записи о завершенных делах
+
+
+def generated(lang):
+    return f"generated_{lang}"
+
+
+def emailed(lang=None):
+    return f"emailed_{lang}" if lang else "emailed"
+
+
+def delivered(steps):
+    """Письма (одно общее или RU и KZ) и строка реестра записаны — только такое дело помечается is_sent=1"""
+    mailed = emailed() in steps or (emailed("RU") in steps and emailed("KZ") in steps)
+    return mailed and LOGGED in steps
+
+
+class IncidentJournal:
+    def __init__(self, path, keep_days=KEEP_DAYS):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS steps (
+                uid TEXT,
+                step TEXT,
+                payload TEXT,
+                at REAL,
+                PRIMARY KEY (uid, step)
+            )""")
+        self._db.commit()
+        self.purge(keep_days)
+
+    def record(self, uid, step, payload=None):
+        """Фиксирует шаг на диске до перехода к следующему"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO steps (uid, step, payload, at) VALUES (?, ?, ?, ?)",
+                (str(uid), step, json.dumps(payload, ensure_ascii=False), time.time()))
+            self._db.commit()
+
+    def steps(self, uid):
+        """{шаг: payload} для дела"""
+        with self._lock:
+            rows = self._db.execute("SELECT step, payload FROM steps WHERE uid = ?", (str(uid),)).fetchall()
+        return {step: json.loads(payload) for step, payload in rows}
+
+    def reset(self, uid):
+        """Начать дело заново (is_sent снова 0 уже после подтвержденной записи — значит, сброшено вручную)"""
+        with self._lock:
+            self._db.execute("DELETE FROM steps WHERE uid = ?", (str(uid),))
+            self._db.commit()
+
+    def uncommitted(self):
+        """Дела, у которых оба текста готовы, но запись в проект еще не подтверждена push-ем:
+        {uid: {шаг: payload}}"""
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT uid, step, payload FROM steps
+                WHERE uid NOT IN (SELECT uid FROM steps WHERE step = ?)""", (COMMITTED,)).fetchall()
+        pending = {}
+        for uid, step, payload in rows:
+            pending.setdefault(uid, {})[step] = json.loads(payload)
+        return {uid: s for uid, s in pending.items()
+                if STARTED in s and generated("RU") in s and generated("KZ") in s}
+
+    def mark_committed(self, uids):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO steps (uid, step, payload, at) VALUES (?, ?, 'null', ?)",
+                [(str(uid), COMMITTED, now) for uid in uids])
+            self._db.commit()
+
+    def purge(self, keep_days):
+        """Удаляет дела, завершенные больше keep_days назад"""
+        with self._lock:
+            self._db.execute("""
+                DELETE FROM steps WHERE uid IN (
+                    SELECT uid FROM steps WHERE step = ? AND at < ?)""",
+                (COMMITTED, time.time() - keep_days * 86400))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,134 @@
+"""Бюджет базы знаний в токенах: руководство + статьи законов в порядке приоритета документов
+для типа нарушения, пока не кончится бюджет. Отчет о том, что не поместилось."""
+import math
+
+from laws_index import tokenize, STEM_LEN
+
+DEFAULT_TOKEN_BUDGET = 6000
+CHARS_PER_TOKEN = 3.5        # Оценка для русского/казахского текста, уточняется calibrate()
+PRIORITY_BOOST = 2.0         # Во сколько раз поднимается вес документов, важных для нарушения
+
+# Основы слов типа нарушения / вопроса -> документы, которые для него важнее остальных.
+# Основа до SHORT_KEYWORD букв совпадает только со словом целиком (гор — горы, но не горит), длиннее — как начало слова.
+SHORT_KEYWORD = 3
+INCIDENT_PRIORITIES = [
+    (["склон", "срезк", "гор", "горн", "предгор", "земл", "участ"],
+     ["01_land_code.txt", "14_land_inspection.txt", "10_presidential_acts.txt"]),
+    (["сад", "садов", "вырубк", "дерев", "зелен", "лес", "лесн"],
+     ["02_eco_code.txt", "08_biodiversity.txt", "12_biodiversity_convention.txt", "14_land_inspection.txt"]),
+    (["вод", "водн", "рек", "речн", "водоохран", "арык"],
+     ["03_water_code.txt", "02_eco_code.txt"]),
+    (["строй", "строит", "застрой", "здани", "котлован", "техник"],
+     ["06_law_architecture.txt", "07_almaty_rules.txt", "01_land_code.txt"]),
+    (["мусор", "свалк", "отход", "шум", "загрязн"],
+     ["02_eco_code.txt", "04_adm_code.txt"]),
+    (["штраф", "наказ", "ответствен", "полици"],
+     ["04_adm_code.txt", "05_crime_code.txt"]),
+    (["климат", "паводк", "сел", "селев"],
+     ["09_climate_adaptation.txt", "11_paris_agreement.txt"]),
+    (["общественн", "обращени", "жалоб", "информаци"],
+     ["13_aarhus_convention.txt"]),
+]
+
+
+class TokenCounter:
+    """Оценка токенов по длине текста. calibrate() один раз сверяет оценку с токенизатором модели."""
+
+    def __init__(self, chars_per_token=CHARS_PER_TOKEN):
+        self.chars_per_token = chars_per_token
+
+    def calibrate(self, client, model, sample):
+        """count_tokens по образцу текста базы (бесплатный вызов); при ошибке остается оценка"""
+        if not sample:
+            return
+        try:
+            total = client.models.count_tokens(model=model, contents=sample).total_tokens
+            if total:
+                self.chars_per_token = len(sample) / total
+                print(f"   🔢 Токенизатор {model}: {self.chars_per_token:.2f} символа на токен", flush=True)
+        except Exception as e:
+            print(f"   ⚠️ count_tokens недоступен ({e}), оценка {self.chars_per_token} символа на токен", flush=True)
+
+    def count(self, text):
+        return math.ceil(len(text or "") / self.chars_per_token)
+
+    def count_chunk(self, chunk, header=""):
+        """Статья базы: число токенов из law_corpus (посчитано с CHARS_PER_TOKEN) с поправкой на калибровку"""
+        if "tokens" in chunk:
+            return math.ceil(chunk["tokens"] * CHARS_PER_TOKEN / self.chars_per_token) + self.count(header)
+        return self.count(header + chunk["text"])
+
+
+def keyword_matches(keyword, tokens):
+    """Совпадение основы со словами текста (tokenize), а не с подстрокой: вод не находится в "производство" """
+    keyword = keyword[:STEM_LEN]
+    if len(keyword) <= SHORT_KEYWORD:
+        return keyword in tokens
+    return any(t.startswith(keyword) for t in tokens)
+
+
+def document_priorities(text):
+    """Вес документа для нарушения/вопроса: {имя файла: вес}; по умолчанию 1.0"""
+    tokens = set(tokenize(text or ""))
+    weights = {}
+    for keywords, files in INCIDENT_PRIORITIES:
+        if any(keyword_matches(k, tokens) for k in keywords):
+            for f in files:
+                weights[f] = PRIORITY_BOOST
+    return weights
+
+
+def budget_context(law_index, query, priority_text=None, token_budget=DEFAULT_TOKEN_BUDGET,
+                   counter=None, header="\n\nИСТОЧНИК: {title}\n"):
+    """Текст базы знаний в пределах token_budget и отчет {'budget', 'used', 'included', 'cut'}.
+    Порядок заполнения: руководство, лучшая статья каждого приоритетного документа,
+    затем остальные найденные статьи по релевантности с учетом веса документа."""
+    counter = counter or TokenCounter()
+    weights = document_priorities(priority_text if priority_text is not None else query)
+    scored = law_index.search_scored(query)
+    if not scored:
+        # BM25 ничего не нашел — берем начало каждого приоритетного документа (если их нет — всех),
+        # чтобы ответ не остался без текста закона
+        scored = [(0.0, c) for c in law_index.chunks if c["pos"] == 0 and (not weights or c["file"] in weights)]
+
+    ranked = sorted(scored, key=lambda x: -x[0] * weights.get(x[1]["file"], 1.0))
+    first_of_doc = {}
+    for score, chunk in ranked:
+        if chunk["file"] in weights:
+            first_of_doc.setdefault(chunk["file"], chunk)
+    order = list(first_of_doc.values()) + [c for _, c in ranked if first_of_doc.get(c["file"]) is not c]
+
+    used = 0
+    guidelines = ""
+    if law_index.guidelines:
+        guidelines = header.format(title=law_index.guidelines_title) + law_index.guidelines
+        used = counter.count(guidelines)
+
+    selected, cut = [], {}
+    for chunk in order:
+        # Заголовок документа считаем с запасом для каждой статьи
+        cost = counter.count_chunk(chunk, header.format(title=chunk["title"]))
+        if used + cost > token_budget:
+            cut[chunk["title"]] = cut.get(chunk["title"], 0) + 1
+            continue
+        used += cost
+        selected.append(chunk)
+
+    # В промпте статьи идут по документам и по порядку внутри документа
+    selected.sort(key=lambda c: (c["file"], c["pos"]))
+    text = guidelines
+    last_file = None
+    for chunk in selected:
+        if chunk["file"] != last_file:
+            text += header.format(title=chunk["title"])
+            last_file = chunk["file"]
+        text += chunk["text"] + "\n\n"
+
+    report = {"budget": token_budget, "used": used, "included": len(selected), "cut": cut}
+    return text, report
+
+
+def format_report(report):
+    cut = ", ".join(f"{title} ({n})" for title, n in sorted(report["cut"].items(), key=lambda x: -x[1]))
+    line = f"{report['used']}/{report['budget']} токенов, статей {report['included']}"
+    return line + (f"; не поместилось: {cut}" if cut else "")
@@ -0,0 +1,197 @@
+"""Скомпилированная база законов — один источник правды для робота и консультанта.
+laws/*.txt собираются в файл .cache/laws-<хэш>.corpus: нормализованный текст, названия документов,
+границы статей и число токенов. При загрузке файл читается целиком (без повторной нормализации
+и разбиения на статьи); CorpusLoader перечитывает его, как только меняется содержимое laws/
+(без перезапуска процесса).
+
+    python law_corpus.py            # собрать заранее (иначе соберется при первом запуске)
+"""
+import os
+import re
+import glob
+import json
+import mmap
+import struct
+import hashlib
+import argparse
+import threading
+import unicodedata
+
+from laws_index import LawIndex, GUIDELINES_FILE, split_articles
+from kb_budget import TokenCounter
+
+LAWS_FOLDER = "laws"
+CORPUS_DIR = os.environ.get("ALMA_CORPUS_DIR", ".cache")
+FORMAT_VERSION = 1
+MAGIC = b"ALMALAW1"
+
+# Заголовок документа в тексте базы (и в промптах, и в инструкции консультанта)
+DOC_HEADER = "\n\n--- ДОКУМЕНТ: {title} ---\n"
+
+FILE_MAPPING = {
+    "00_guidelines.txt": "Руководство и Стратегия ALMA",
+    "01_land_code.txt": "Земельный кодекс РК",
+    "02_eco_code.txt": "Экологический кодекс РК",
+    "03_water_code.txt": "Водный кодекс РК",
+    "04_adm_code.txt": "Кодекс об административных правонарушениях (КоАП)",
+    "05_crime_code.txt": "Уголовный кодекс РК",
+    "06_law_architecture.txt": "Закон об архитектурной и градостроительной деятельности",
+    "07_almaty_rules.txt": "Правила застройки, ПЗЗ и Генплан Алматы",
+    "08_biodiversity.txt": "Законодательство о биоразнообразии и ООПТ",
+    "09_climate_adaptation.txt": "Климатическая стратегия и адаптация",
+    "10_presidential_acts.txt": "Акты и Поручения Президента РК",
+    "11_paris_agreement.txt": "Парижское соглашение (Климат)",
+    "12_biodiversity_convention.txt": "Конвенция о биологическом разнообразии",
+    "13_aarhus_convention.txt": "Орхусская конвенция (Права общественности)",
+    "14_land_inspection.txt": "Полномочия Земельной инспекции (ДУЗР МСХ РК)"
+}
+
+
+def source_files(folder):
+    return sorted(glob.glob(os.path.join(folder, "*.txt")))
+
+
+def corpus_fingerprint(folder):
+    """Быстрая проверка изменений laws/*.txt: имена, размеры и время изменения (без чтения файлов)"""
+    h = hashlib.sha256()
+    for path in source_files(folder):
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def content_hash(folder, file_mapping=FILE_MAPPING):
+    """Версия базы: содержимое файлов, названия документов и формат файла"""
+    h = hashlib.sha256(f"v{FORMAT_VERSION}\n".encode("utf-8"))
+    h.update(json.dumps(file_mapping, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    for path in source_files(folder):
+        h.update(os.path.basename(path).encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def normalize_text(text):
+    """NFC, переводы строк \\n, без хвостовых пробелов и длинных пустых промежутков"""
+    text = unicodedata.normalize("NFC", text.replace("\r\n", "\n").replace("\r", "\n"))
+    text = "\n".join(line.rstrip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def artifact_path(cache_dir, digest):
+    return os.path.join(cache_dir, f"laws-{digest}.corpus")
+
+
+def compile_corpus(folder, out_path, digest, file_mapping=FILE_MAPPING):
+    """Собирает файл базы: MAGIC, длина заголовка (uint32), заголовок JSON, тексты UTF-8 подряд"""
+    counter = TokenCounter()
+    body = bytearray()
+    header = {"format": FORMAT_VERSION, "hash": digest, "guidelines": None, "documents": [], "chunks": []}
+
+    def put(text):
+        data = text.encode("utf-8")
+        offset = len(body)
+        body.extend(data)
+        return {"offset": offset, "length": len(data), "tokens": counter.count(text)}
+
+    for f_path in source_files(folder):
+        filename_raw = os.path.basename(f_path)
+        try:
+            with open(f_path, "r", encoding="utf-8") as f:
+                content = normalize_text(f.read())
+        except Exception as e:
+            print(f"   ⚠️ Не удалось прочитать {filename_raw}: {e}", flush=True)
+            continue
+        title = file_mapping.get(filename_raw, filename_raw)
+        if filename_raw == GUIDELINES_FILE:
+            header["guidelines"] = {"title": title, **put(content)}
+            continue
+        header["documents"].append({"file": filename_raw, "title": title})
+        for pos, text in enumerate(split_articles(content)):
+            header["chunks"].append({"file": filename_raw, "pos": pos, **put(text)})
+
+    head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(head)) + head + bytes(body))
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def read_corpus(path):
+    """LawIndex из файла базы: все статьи декодируются в строки сразу, файл после чтения закрывается"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path}: не файл базы законов")
+        (head_len,) = struct.unpack("<I", mm[len(MAGIC):len(MAGIC) + 4])
+        start = len(MAGIC) + 4
+        header = json.loads(mm[start:start + head_len].decode("utf-8"))
+        base = start + head_len
+
+        def text(entry):
+            return mm[base + entry["offset"]:base + entry["offset"] + entry["length"]].decode("utf-8")
+
+        titles = {d["file"]: d["title"] for d in header["documents"]}
+        chunks = [
+            {"file": c["file"], "title": titles[c["file"]], "pos": c["pos"], "text": text(c), "tokens": c["tokens"]}
+            for c in header["chunks"]
+        ]
+        g = header["guidelines"]
+        law_index = LawIndex(chunks, text(g) if g else "", g["title"] if g else GUIDELINES_FILE)
+    law_index.version = header["hash"]
+    return law_index
+
+
+def load_corpus(folder=LAWS_FOLDER, cache_dir=CORPUS_DIR, file_mapping=FILE_MAPPING):
+    """Файл базы для текущего содержимого laws/: готовый или собранный сейчас. Старые версии удаляются."""
+    digest = content_hash(folder, file_mapping)
+    path = artifact_path(cache_dir, digest)
+    if not os.path.exists(path):
+        print(f"📚 Собираю базу законов {digest}...", flush=True)
+        compile_corpus(folder, path, digest, file_mapping)
+    for old in glob.glob(artifact_path(cache_dir, "*")):
+        if old != path:
+            try: os.remove(old)
+            except OSError: pass
+    return read_corpus(path)
+
+
+class CorpusLoader:
+    """Текущая база для долгоживущих процессов: current() перечитывает файл, когда меняется laws/"""
+
+    def __init__(self, folder=LAWS_FOLDER, cache_dir=CORPUS_DIR, file_mapping=FILE_MAPPING):
+        self.folder = folder
+        self.cache_dir = cache_dir
+        self.file_mapping = file_mapping
+        self.fingerprint = None
+        self.law_index = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        fingerprint = corpus_fingerprint(self.folder)
+        with self._lock:
+            if fingerprint != self.fingerprint:
+                law_index = load_corpus(self.folder, self.cache_dir, self.file_mapping)
+                if self.law_index is not None and law_index.version != self.law_index.version:
+                    print(f"🔄 База законов обновлена: {law_index.version}", flush=True)
+                self.law_index, self.fingerprint = law_index, fingerprint
+            return self.law_index
+
+    @property
+    def version(self):
+        return self.current().version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка laws/*.txt в файл базы законов")
+    parser.add_argument("--laws", default=LAWS_FOLDER)
+    parser.add_argument("--out-dir", default=CORPUS_DIR)
+    args = parser.parse_args()
+    law_index = load_corpus(args.laws, args.out_dir)
+    tokens = sum(c["tokens"] for c in law_index.chunks)
+    print(f"✅ {artifact_path(args.out_dir, law_index.version)}: статей {len(law_index.chunks)}, ~{tokens} токенов", flush=True)
+
+
+if __name__ == "__main__":
+    main()
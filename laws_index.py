@@ -0,0 +1,117 @@
+"""Поисковый индекс по папке laws/: законы режутся на статьи, в промпт идут только релевантные (BM25)"""
+import re
+import math
+from collections import Counter
+
+GUIDELINES_FILE = "00_guidelines.txt"
+
+# Граница фрагмента: "Статья 12. ..." или заголовок раздела "--- ГЛАВА 13 ---"
+ARTICLE_START = re.compile(r"^\s*(Статья\s+\d|---\s)")
+TOKEN_RE = re.compile(r"\w+")
+
+# Стемминг для русского: отрезаем окончание (падеж, число, род), затем сравниваем по первым буквам
+STEM_LEN = 6
+MIN_TOKEN_LEN = 3
+MIN_STEM_LEN = 3
+REFLEXIVE_ENDINGS = ("ся", "сь")
+ENDINGS = sorted([
+    # прилагательные и причастия
+    "ыми", "ими", "ого", "его", "ому", "ему", "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ей",
+    "ым", "им", "ом", "ем", "ую", "юю", "ых", "их",
+    # существительные
+    "иями", "ями", "ами", "иях", "ях", "ах", "ией", "ием", "иям", "ям", "ов", "ев", "ью",
+    "а", "я", "о", "е", "и", "ы", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def stem(word):
+    """мусора -> мусор, воды -> вод, земельного -> земель: окончание отрезается, пока основа не короче MIN_STEM_LEN"""
+    for ending in REFLEXIVE_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LEN:
+            word = word[:-len(ending)]
+            break
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LEN:
+            word = word[:-len(ending)]
+            break
+    return word[:STEM_LEN]
+
+
+def tokenize(text):
+    tokens = []
+    for word in TOKEN_RE.findall(text.lower()):
+        if len(word) < MIN_TOKEN_LEN and not word.isdigit():
+            continue
+        tokens.append(stem(word))
+    return tokens
+
+
+def split_articles(text):
+    """Делит текст закона на фрагменты по статьям и заголовкам разделов"""
+    chunks, current = [], []
+    for line in text.splitlines():
+        if ARTICLE_START.match(line) and any(l.strip() for l in current):
+            chunks.append("\n".join(current).strip())
+            current = []
+        current.append(line)
+    if any(l.strip() for l in current):
+        chunks.append("\n".join(current).strip())
+    return chunks
+
+
+class LawIndex:
+    """BM25 по статьям законов. Руководство (00_guidelines.txt) добавляется в контекст всегда."""
+
+    def __init__(self, chunks, guidelines="", guidelines_title=GUIDELINES_FILE):
+        # chunks: список словарей {"file", "title", "pos", "text"}
+        self.chunks = chunks
+        self.guidelines = guidelines
+        self.guidelines_title = guidelines_title
+        self.version = None  # хэш содержимого, если индекс загружен из law_corpus
+        self.doc_freq = Counter()
+        self.term_freqs = []
+        for chunk in chunks:
+            tf = Counter(tokenize(chunk["title"] + "\n" + chunk["text"]))
+            self.term_freqs.append(tf)
+            self.doc_freq.update(tf.keys())
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_len = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def idf(self, term):
+        n = len(self.chunks)
+        df = self.doc_freq.get(term, 0)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search_scored(self, query):
+        """Все фрагменты с ненулевой релевантностью: [(score, chunk)] по убыванию score"""
+        terms = set(tokenize(query or ""))
+        if not terms or not self.chunks:
+            return []
+        scored = []
+        for i, tf in enumerate(self.term_freqs):
+            score = 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / (self.avg_len or 1))
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf(term) * freq * (BM25_K1 + 1) / (freq + norm)
+            if score > 0:
+                scored.append((score, i))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [(score, self.chunks[i]) for score, i in scored]
+
+    def full_text(self, header="\n\nИСТОЧНИК: {title}\n"):
+        """Вся база целиком (руководство + все статьи) — для загрузки в кэш контекста"""
+        text = ""
+        if self.guidelines:
+            text += header.format(title=self.guidelines_title) + self.guidelines
+        last_file = None
+        for chunk in self.chunks:
+            if chunk["file"] != last_file:
+                text += header.format(title=chunk["title"])
+                last_file = chunk["file"]
+            text += chunk["text"] + "\n\n"
+        return text
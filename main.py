@@ -5,14 +5,18 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import os
+import json
 import glob
 import smtplib
 import shutil
 import time
+import signal
+import argparse
+import threading
 import pandas as pd
 import geopandas as gpd
 from datetime import datetime
-import PIL.Image
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ИСПОЛЬЗУЕМ НОВУЮ БИБЛИОТЕКУ (Google GenAI SDK)
 from google import genai
@@ -25,7 +29,20 @@ from oauth2client.service_account import ServiceAccountCredentials
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
-from mergin import MerginClient, ClientError # Добавили импорт ошибки
+from mergin import MerginClient, MerginProject, ClientError # Добавили импорт ошибки
+
+from law_corpus import CorpusLoader, load_corpus, DOC_HEADER
+from gen_cache import GenerationCache, cached_generate, hash_bytes
+from photos import prepare_photo, archive_photo
+from rate_limit import RateLimiter, BudgetExceeded
+from model_selector import ModelSelector
+from metrics import METRICS, stage
+from gpkg_io import update_gpkg_rows, read_pending_incidents, read_photo_index
+from context_cache import ContextCacheManager, CACHED_CORPUS_NOTE
+from kb_budget import TokenCounter, budget_context, format_report
+from journal import IncidentJournal, STARTED, LOGGED, COMMITTED, generated, emailed, delivered
+from batch_gen import BatchManager
+from dedup import cluster_incidents
 
 print("✅ Библиотеки загружены.", flush=True)
 
@@ -33,36 +50,50 @@ print("✅ Библиотеки загружены.", flush=True)
 MERGIN_PROJECT = "ALMA_exmachina/alma_bot"
 PROJECT_PATH = "./project"
 ARCHIVE_PATH = "./ALMA_ARCHIVE"
+# incremental — рабочая копия сохраняется между запусками (кэш в workflow), full — скачивать заново
+SYNC_MODE = os.environ.get("ALMA_SYNC_MODE", "incremental")
+RUN_STATE_FILE = os.path.join(ARCHIVE_PATH, "run_state.json")
+MODEL_STATE_FILE = os.path.join(ARCHIVE_PATH, "model_state.json") # Последняя рабочая модель (вместо Ping на каждом старте)
+METRICS_FILE = os.path.join(ARCHIVE_PATH, "metrics.jsonl") # Строка метрик на каждый запуск/цикл
+PROFILE_FILE = os.path.join(ARCHIVE_PATH, "profile.prof") # main.py --profile
+HEARTBEAT_FILE = os.path.join(ARCHIVE_PATH, "heartbeat.json") # Пишется в режиме --daemon после каждого цикла
+JOURNAL_FILE = os.path.join(ARCHIVE_PATH, "journal.sqlite") # Шаги обработки каждого дела — продолжение после сбоя
+DAEMON_POLL_SECONDS = int(os.environ.get("ALMA_POLL_SECONDS", "60"))
+PHOTO_STORE_PATH = os.path.join(ARCHIVE_PATH, "PHOTOS", "_store") # Оригиналы фото по хэшу содержимого
 GOOGLE_SHEET_NAME = "ALMA_Registry"
 CREDENTIALS_FILE = "service_account.json"
+SHEET_HEADERS = ["Дата", "ID Дела", "Кадастр", "Тип нарушения", "Координаты", "Ответ AI (RU)", "Ответ AI (KZ)", "Путь к фото"]
+COMBINED_EMAIL = os.environ.get("ALMA_COMBINED_EMAIL", "") == "1" # RU и KZ одним письмом
+SHEET_FLUSH_EVERY = 20 # Строк в буфере до промежуточной записи в реестр
+GEN_CACHE_FILE = os.path.join(ARCHIVE_PATH, "gen_cache.sqlite") # Кэш ответов AI (ALMA_NO_CACHE=1 — отключить)
+# ALMA_CONTEXT_CACHE=1 — вся база законов один раз загружается в кэш контекста Gemini вместо top-k статей в каждом промпте
+CONTEXT_CACHE = os.environ.get("ALMA_CONTEXT_CACHE", "") == "1"
+CONTEXT_CACHE_FILE = os.path.join(ARCHIVE_PATH, "context_cache.json") # Имя и срок кэша между запусками
+# ALMA_BATCH_THRESHOLD=N — от N запросов к AI за запуск генерация уходит в пакетное задание (Batch API, ответ
+# может идти часами); по умолчанию 0 — выключено, дела отправляются в том же запуске
+BATCH_THRESHOLD = int(os.environ.get("ALMA_BATCH_THRESHOLD", "0"))
+BATCH_STATE_FILE = os.path.join(ARCHIVE_PATH, "batch_jobs.json") # Незавершенные пакетные задания
 
 INCIDENTS_FILE = "Инцидент.gpkg"
 PHOTOS_FILE = "photos.gpkg"
+# Повторные сообщения: тот же тип и кадастр, ближе ALMA_DEDUP_METERS и ALMA_DEDUP_MINUTES — одно дело (0 м — не склеивать)
+DEDUP_METERS = float(os.environ.get("ALMA_DEDUP_METERS", "50"))
+DEDUP_MINUTES = float(os.environ.get("ALMA_DEDUP_MINUTES", "120"))
+DEDUP_TIME_COLUMN = os.environ.get("ALMA_DEDUP_TIME_COLUMN", "date") # Если колонки нет, окно по времени не проверяется
+# Колонки инцидента, которые реально нужны роботу (остальные из GPKG не читаются)
+INCIDENT_COLUMNS = ["unique-id", "incident_type", "description", "volunteer_email", "layers", "is_sent", DEDUP_TIME_COLUMN]
 LAWS_FOLDER = "laws"
 GARDEN_KEYWORDS = ["сады", "orchards", "защищенные", "проверке", "возвращенный"]
-MAX_LAW_CHARS = 200000 
+EMAIL_RECIPIENTS = [e.strip() for e in os.environ.get("ALMA_RECIPIENTS", "").split(",") if e.strip()] # Копии всех писем (кроме отправителя и волонтера)
+MAX_PARALLEL_INCIDENTS = int(os.environ.get("ALMA_PARALLEL_INCIDENTS", "3")) # Дел в генерации одновременно (RU и KZ идут параллельно)
+GEMINI_RPM = int(os.environ.get("ALMA_GEMINI_RPM", "10")) # Стартовая скорость, дальше подстраивается под квоту
+GEMINI_RUN_BUDGET = int(os.environ.get("ALMA_GEMINI_BUDGET", "300")) # Максимум запросов к модели за запуск
+LAW_TOKEN_BUDGET = int(os.environ.get("ALMA_LAW_TOKENS", "6000")) # Токенов базы знаний в промпте (руководство + статьи по приоритету)
 
 MODEL_CANDIDATES = [
     "gemini-2.0-flash-exp"
 ]
 
-FILE_MAPPING = {
-    "00_guidelines.txt": "Руководство и Стратегия ALMA",
-    "01_land_code.txt": "Земельный кодекс РК",
-    "02_eco_code.txt": "Экологический кодекс РК",
-    "03_water_code.txt": "Водный кодекс РК",
-    "04_adm_code.txt": "КоАП РК",
-    "05_crime_code.txt": "Уголовный кодекс РК",
-    "06_law_architecture.txt": "Закон об архитектуре",
-    "07_almaty_rules.txt": "ПЗЗ и Генплан Алматы",
-    "08_biodiversity.txt": "Биоразнообразие",
-    "10_presidential_acts.txt": "Акты Президента",
-    "11_paris_agreement.txt": "Парижское соглашение",
-    "12_biodiversity_convention.txt": "Конвенция о биоразнообразии",
-    "13_aarhus_convention.txt": "Орхусская конвенция",
-    "14_land_inspection.txt": "Полномочия Земельной инспекции"
-}
-
 os.makedirs(ARCHIVE_PATH, exist_ok=True)
 os.makedirs(os.path.join(ARCHIVE_PATH, "PHOTOS"), exist_ok=True)
 
@@ -81,44 +112,104 @@ def setup_google_credentials():
     else:
         print("❌ ОШИБКА: Нет GOOGLE_CREDENTIALS_JSON в секретах!", flush=True)
 
-def log_to_google_sheet(data_row):
-    if not os.path.exists(CREDENTIALS_FILE):
-        return
-    try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-        client_gs = gspread.authorize(creds)
-        sheet = client_gs.open(GOOGLE_SHEET_NAME).sheet1
-        
-        if not sheet.get_all_values():
-            headers = ["Дата", "ID Дела", "Кадастр", "Тип нарушения", "Координаты", "Ответ AI (RU)", "Ответ AI (KZ)", "Путь к фото"]
-            sheet.append_row(headers)
-        
-        sheet.append_row(data_row)
-        print("   📊 Записано в Google Sheets.", flush=True)
-    except Exception as e:
-        print(f"   ❌ Ошибка записи в Google Sheets: {e}", flush=True)
+class RegistryWriter:
+    """Реестр дел в Google Sheets: одна авторизация за запуск, строки копятся и уходят пачкой (append_rows)"""
+
+    def __init__(self, sheet_name=GOOGLE_SHEET_NAME, flush_every=SHEET_FLUSH_EVERY):
+        self.sheet_name = sheet_name
+        self.flush_every = flush_every
+        self.sheet = None
+        self.disabled = False
+        self.rows = []
+        self.on_written = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.sheet is not None or self.disabled:
+            return self.sheet
+        if not os.path.exists(CREDENTIALS_FILE):
+            self.disabled = True
+            return None
+        try:
+            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
+            client_gs = gspread.authorize(creds)
+            sheet = client_gs.open(self.sheet_name).sheet1
+
+            # Заголовок проверяем чтением одной ячейки, а не выгрузкой всего реестра
+            if not sheet.acell('A1').value:
+                sheet.append_row(SHEET_HEADERS)
+            self.sheet = sheet
+        except Exception as e:
+            print(f"   ❌ Ошибка подключения к Google Sheets: {e}", flush=True)
+        return self.sheet
+
+    def add(self, data_row, on_written=None):
+        """on_written() вызывается, когда строка реально записана в таблицу"""
+        with self._lock:
+            self.rows.append(data_row)
+            self.on_written.append(on_written)
+            if len(self.rows) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _done(self):
+        for callback in self.on_written:
+            if callback: callback()
+        self.rows, self.on_written = [], []
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if not self._connect():
+            if self.disabled:
+                # Реестр необязателен: без service_account.json строки считаются записанными,
+                # иначе дела никогда не получили бы is_sent=1
+                self._done()
+            return
+        try:
+            with stage("sheets.flush"):
+                self.sheet.append_rows(self.rows)
+            METRICS.count("sheets.rows", len(self.rows))
+            print(f"   📊 Записано в Google Sheets: {len(self.rows)} строк.", flush=True)
+            self._done()
+        except Exception as e:
+            print(f"   ❌ Ошибка записи в Google Sheets (строк в очереди: {len(self.rows)}): {e}", flush=True)
 
 def load_knowledge_base():
-    full_text = ""
-    files = sorted(glob.glob(os.path.join(LAWS_FOLDER, "*.txt")))
-    if not files: return "База законов пуста."
-    total_chars = 0
+    """Скомпилированная база законов (law_corpus); в режиме --daemon перечитывается при изменении laws/"""
     print(f"📚 Читаю законы...", flush=True)
-    for f_path in files:
-        if total_chars >= MAX_LAW_CHARS: break
-        try:
-            with open(f_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                filename_raw = os.path.basename(f_path)
-                doc_title = FILE_MAPPING.get(filename_raw, filename_raw)
-                if "00_" not in filename_raw and len(content) > 30000:
-                    content = content[:30000] + "\n...[СОКР]..."
-                
-                full_text += f"\n\nИСТОЧНИК: {doc_title}\n" + content
-                total_chars += len(content)
-        except: pass
-    return full_text
+    corpus = CorpusLoader(LAWS_FOLDER)
+    law_index = corpus.current()
+    print(f"   База {law_index.version}, статей в индексе: {len(law_index.chunks)}", flush=True)
+    return corpus
+
+def select_legal_context(law_index, counter, uid, inc_type, desc):
+    """Руководство + статьи по типу нарушения и описанию в пределах LAW_TOKEN_BUDGET"""
+    query = f"{inc_type or ''} {desc or ''}"
+    text, report = budget_context(law_index, query, priority_text=query, token_budget=LAW_TOKEN_BUDGET,
+                                  counter=counter, header=DOC_HEADER)
+    print(f"   📚 [{uid}] База знаний: {format_report(report)}", flush=True)
+    METRICS.count("kb.tokens", report["used"])
+    METRICS.count("kb.cut_chunks", sum(report["cut"].values()))
+    return text
+
+def job_legal_knowledge(job):
+    """Статьи для промпта дела: подбираются при первом запросе без кэша контекста, один раз на дело
+    (с кэшем контекста в промпт идет только ссылка, и метрики kb.* не должны считать неотправленное)"""
+    with job["legal_lock"]:
+        if job["legal_knowledge"] is None:
+            job["legal_knowledge"] = select_legal_context(*job["legal_query"])
+        return job["legal_knowledge"]
+
+def build_cached_corpus():
+    """Содержимое кэша контекста: инструкция + руководство и все законы (читается с диска заново —
+    кэш пересоздается как раз тогда, когда laws/ изменилась)"""
+    system_instruction = "Ты Юрист-эколог движения ALMA. Ниже — база знаний: руководство \"00_guidelines.txt\" и законы РК."
+    return system_instruction, load_corpus(LAWS_FOLDER).full_text(header=DOC_HEADER)
 
 def get_legal_prompt(lang, inc_type, desc, cad_id, coords, legal_db):
     if lang == "RU":
@@ -171,38 +262,251 @@ def get_legal_prompt(lang, inc_type, desc, cad_id, coords, legal_db):
     2. ПРОЕКТ {subject_hint} (Текст для госоргана, соответствующий выбранному сценарию).
     """
 
-def send_email_with_attachments(to_email, subject, body, attachment_paths):
-    sender = get_env('MERGIN_USER') 
-    password = get_env('GMAIL_APP_PASS')
-    if not sender or not password: return
+def build_attachments(photos):
+    """MIME-кодирует уменьшенные фото один раз — один и тот же набор идет во все письма по делу"""
+    return [MIMEImage(p["jpeg"], _subtype="jpeg", name=p["name"]) for p in photos]
 
-    msg = MIMEMultipart()
-    msg['From'] = sender
-    msg['To'] = f"{sender}, {to_email}"
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
+class Mailer:
+    """Одна SMTP-сессия на весь запуск. При обрыве соединения переподключается и повторяет отправку."""
 
-    for f_path in attachment_paths:
-        if f_path and os.path.exists(f_path):
-            try:
-                with open(f_path, 'rb') as f:
-                    img_data = f.read()
-                    image = MIMEImage(img_data, name=os.path.basename(f_path))
-                    msg.attach(image)
-            except: pass
+    def __init__(self, recipients=()):
+        self.sender = get_env('MERGIN_USER')
+        self.recipients = list(recipients)
+        self.password = get_env('GMAIL_APP_PASS')
+        self.smtp = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.smtp = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        self.smtp.login(self.sender, self.password)
+
+    def _drop(self):
+        if self.smtp is not None:
+            try: self.smtp.close()
+            except Exception: pass
+        self.smtp = None
+
+    def send(self, to_email, subject, body, attachment_parts):
+        """True — письмо отправлено или почта не настроена (нет MERGIN_USER / GMAIL_APP_PASS): тогда
+        письма необязательны, как и реестр, и дело не должно вечно ждать отправки"""
+        if not self.sender or not self.password: return True
+
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = ", ".join([f"{self.sender}, {to_email}"] + self.recipients)
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+        for part in attachment_parts:
+            msg.attach(part)
+
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    with stage("smtp.send"):
+                        if self.smtp is None:
+                            self._connect()
+                            METRICS.count("smtp.logins")
+                        self.smtp.send_message(msg)
+                    METRICS.count("smtp.messages")
+                    METRICS.count("smtp.upload_bytes", len(body.encode("utf-8")) + sum(len(p.get_payload()) for p in attachment_parts))
+                    print(f"   ✉️ Почта отправлена ({subject})", flush=True)
+                    return True
+                except Exception as e:
+                    self._drop()
+                    if attempt:
+                        print(f"   ❌ Ошибка почты: {e}", flush=True)
+                    else:
+                        METRICS.count("smtp.retries")
+                        print(f"   ⚠️ SMTP: {e} — переподключаюсь...", flush=True)
+        return False
+
+    def close(self):
+        with self._lock:
+            if self.smtp is not None:
+                try: self.smtp.quit()
+                except Exception: pass
+            self.smtp = None
+
+def get_row_cadastre(row):
+    """Кадастр из поля 'layers' самого инцидента (если заполнено)"""
+    if 'layers' in row:
+        val = row.get('layers')
+        if val and str(val).strip():
+            return str(val)
+    return None
+
+def load_garden_layers(garden_files):
+    """Читает и перепроецирует слои садов ОДИН раз за запуск, сразу строит пространственный индекс (STRtree)"""
+    layers = []
+    for g_file in garden_files:
+        try:
+            gdf = gpd.read_file(g_file).to_crs("EPSG:4326")
+        except Exception as e:
+            print(f"   ⚠️ Слой {os.path.basename(g_file)} не прочитан: {e}", flush=True)
+            continue
+        if gdf.empty: continue
+
+        # УМНЫЙ ПОИСК КОЛОНКИ: ищем что-то похожее на 'layer'
+        found_col = None
+        for col in gdf.columns:
+            if 'layer' in col.lower() or 'kadastr' in col.lower() or 'name' in col.lower():
+                found_col = col
+                break
+
+        shapes = gpd.GeoDataFrame(geometry=gdf.geometry)
+        shapes.sindex  # STRtree строится здесь, а не при первом запросе
+        layers.append({"file": g_file, "gdf": gdf, "shapes": shapes, "col": found_col})
+    return layers
+
+def find_garden_cadastres(points, garden_layers):
+    """Пакетное гео-пересечение точек (GeoSeries в EPSG:4326) со слоями садов.
+    Как и раньше, побеждает первый слой по порядку файлов и первый полигон внутри слоя.
+    Возвращает {индекс инцидента: (cad_id, найденная колонка или None, имя файла слоя)}"""
+    hits = {}
+    pending = gpd.GeoDataFrame(geometry=points)
+    for layer in garden_layers:
+        if pending.empty: break
+        joined = gpd.sjoin(pending, layer["shapes"], how="inner", predicate="within")
+        if joined.empty: continue
+
+        joined = joined.sort_values("index_right", kind="stable")
+        first = joined[~joined.index.duplicated(keep="first")]
+        layer_name = os.path.basename(layer["file"])
+        for idx, right_idx in first["index_right"].items():
+            if layer["col"]:
+                cad_id = str(layer["gdf"].at[right_idx, layer["col"]])
+            else:
+                cad_id = os.path.splitext(layer_name)[0]
+            hits[idx] = (cad_id, layer["col"], layer_name)
+        pending = pending.drop(first.index)
+    return hits
+
+def find_incident_photos(uid, photo_index):
+    """Пути к исходным фото инцидента внутри папки проекта (photo_index: external_pk -> [photo])"""
+    found = []
+    for original in photo_index.get(uid, []):
+        possible_paths = [os.path.join(PROJECT_PATH, original), os.path.join(PROJECT_PATH, os.path.basename(original))]
+        src = next((p for p in possible_paths if os.path.exists(p)), None)
+        if src:
+            found.append(src)
+    return found
+
+def prepare_incident_photos(photo_paths):
+    """Стадия подготовки фото: каждое фото декодируется один раз, дальше RU/KZ и почта берут готовый JPEG"""
+    prepared = []
+    for src in photo_paths:
+        try:
+            with stage("photos.prepare"):
+                prepared.append(prepare_photo(src))
+            METRICS.count("photos.original_bytes", os.path.getsize(src))
+            METRICS.count("photos.prepared_bytes", len(prepared[-1]["jpeg"]))
+        except Exception as e:
+            print(f"   ⚠️ Фото {os.path.basename(src)} не обработано: {e}", flush=True)
+    return prepared
+
+def archive_incident_photos(job):
+    """Стадия архива: оригиналы в хранилище по хэшу, в ALMA_ARCHIVE/PHOTOS/<дата>_<id> — жесткие ссылки.
+    Архивируются все найденные фото, в том числе те, что не удалось декодировать (битые, HEIC)."""
+    hashes = {photo["src"]: photo["hash"] for photo in job["photos_ready"].result()}
+    for src in job["photos"]:
+        with stage("photos.archive"):
+            content_hash = hashes.get(src)
+            if content_hash is None:
+                with open(src, "rb") as f:
+                    content_hash = hash_bytes(f.read())
+            archive_photo(src, content_hash, PHOTO_STORE_PATH, job["photo_dir"])
+
+def build_contents(lang, job, legal_db):
+    """Промпт и фото дела для запроса к модели"""
+    prompt = get_legal_prompt(lang, job["incident_type"], job["description"], job["cad_id"], job["coords"], legal_db)
+    photos = job["photos_ready"].result()
+    return [prompt] + [types.Part.from_bytes(data=p["jpeg"], mime_type="image/jpeg") for p in photos]
+
+def clean_response(text):
+    return text.replace("**", "").replace("##", "").replace("--- ДОКУМЕНТ:", "")
+
+def generate_text(client, gen_cache, limiter, selector, lang, job, context_cache=None, journal=None):
+    """Стадия генерации: текст обращения на одном языке. При ошибке возвращает None."""
+    done = job["journal"].get(generated(lang))
+    if done:
+        print(f"   ♻️ [{job['uid']}] {lang} уже готов (журнал)", flush=True)
+        return done
+    print(f"   🧬 [{job['uid']}] Генерация {lang}...", flush=True)
+    model_name = selector.current()
+    # База в кэше контекста — в промпт идет только ссылка на нее, иначе найденные статьи текстом
+    cache_name = context_cache.get(model_name) if context_cache else None
+    legal_db = CACHED_CORPUS_NOTE if cache_name else job_legal_knowledge(job)
+    contents_list = build_contents(lang, job, legal_db)
+    image_hashes = [p["key"] for p in job["photos_ready"].result()]
 
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as s:
-            s.login(sender, password)
-            s.send_message(msg)
-        print(f"   ✉️ Почта отправлена ({subject})", flush=True)
+        with stage("gemini.generate"):
+            resp_text = cached_generate(
+                client, gen_cache, model_name, contents_list,
+                config=types.GenerateContentConfig(temperature=0.0, cached_content=cache_name),
+                image_hashes=image_hashes,
+                limiter=limiter
+            )
+        selector.report_success(model_name)
+        text = clean_response(resp_text)
+        if journal:
+            journal.record(job["uid"], generated(lang), text)
+        return text
+    except BudgetExceeded as e:
+        print(f"   ⛔ [{job['uid']}] {lang} отложено до следующего запуска: {e}", flush=True)
     except Exception as e:
-        print(f"   ❌ Ошибка почты: {e}", flush=True)
+        selector.report_failure(model_name)
+        if cache_name:
+            context_cache.invalidate()
+        print(f"   ❌ [{job['uid']}] Ошибка AI {lang} ({model_name}): {e}", flush=True)
+    return None
+
+def job_generated(job):
+    """Дело можно отправлять и помечать is_sent=1 только если оба текста реально получены"""
+    return all(job["responses"].get(lang) for lang in ["RU", "KZ"])
+
+def deliver_incident(job, registry, mailer, journal):
+    """Стадия отправки: письма RU/KZ волонтеру и строка в реестр Google Sheets.
+    Шаги, уже выполненные прерванным запуском (по журналу), не повторяются."""
+    if COMBINED_EMAIL:
+        subj = f"ALMA КОНСУЛЬТАЦИЯ / КЕҢЕСІ: {job['cad_id']}"
+        body = job["responses"]["RU"] + "\n\n" + "=" * 40 + "\n\n" + job["responses"]["KZ"]
+        letters = [(emailed(), subj, body)]
+    else:
+        letters = [
+            (emailed(lang), f"ALMA {'КОНСУЛЬТАЦИЯ' if lang=='RU' else 'КЕҢЕСІ'}: {job['cad_id']}", job["responses"][lang])
+            for lang in ["RU", "KZ"]
+        ]
+    letters = [l for l in letters if l[0] not in job["journal"]]
+    if letters:
+        with stage("smtp.encode"):
+            attachment_parts = build_attachments(job["photos_ready"].result())
+    for step, subj, body in letters:
+        if mailer.send(job["email"], subj, body, attachment_parts):
+            journal.record(job["uid"], step)
+
+    if LOGGED in job["journal"]:
+        print(f"   ♻️ [{job['uid']}] Строка реестра уже записана", flush=True)
+        return
+
+    # --- GOOGLE SHEETS ---
+    sheet_row = [
+        datetime.now().strftime("%Y-%m-%d %H:%M"),
+        ", ".join([job["uid"]] + list(job["members"])),
+        job["cad_id"], 
+        job["incident_type"], 
+        job["coords"],
+        job["responses"]["RU"], 
+        job["responses"]["KZ"], 
+        os.path.abspath(job["photo_dir"])
+    ]
+    registry.add(sheet_row, on_written=lambda: journal.record(job["uid"], LOGGED))
 
 def sync_project_safely(mc, project_path):
-    """Пытается отправить изменения. Если версия устарела, обновляет и пробует снова."""
+    """Пытается отправить изменения. Если версия устарела, обновляет и пробует снова. Возвращает True при успехе."""
     try:
         mc.push_project(project_path)
+        return True
     except ClientError as e:
         if "There is a new version" in str(e):
             print("   ⚠️ Версия на сервере изменилась. Выполняю слияние...", flush=True)
@@ -210,57 +514,182 @@ def sync_project_safely(mc, project_path):
                 mc.pull_project(project_path) # Скачиваем изменения (v93)
                 mc.push_project(project_path) # Отправляем наши изменения поверх
                 print("   ✅ Синхронизация восстановлена.", flush=True)
+                return True
             except Exception as e2:
                 print(f"   ❌ Не удалось восстановить синхронизацию: {e2}", flush=True)
         else:
             print(f"   ❌ Ошибка отправки проекта: {e}", flush=True)
+    return False
 
-def main():
-    print("🚀 ЗАПУСК ALMA 8.9 (SYNC FIX + SMART COLUMNS)", flush=True)
-    
-    setup_google_credentials()
+def local_project_version(project_path):
+    """Версия локальной рабочей копии Mergin (например 'v93') или None"""
+    try:
+        mp = MerginProject(project_path)
+        return mp.version() if callable(getattr(mp, "version", None)) else mp.metadata.get("version")
+    except Exception:
+        return None
 
+def load_run_state():
     try:
-        mc = MerginClient("https://app.merginmaps.com", login=get_env('MERGIN_USER'), password=get_env('MERGIN_PASS'))
-        print("✅ Mergin Maps: OK", flush=True)
+        with open(RUN_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_run_state(version, clean):
+    """Запоминает, какая версия проекта обработана; clean=False — остались неотправленные дела или изменения"""
+    with open(RUN_STATE_FILE, 'w', encoding='utf-8') as f:
+        json.dump({"version": version, "clean": clean, "time": datetime.now().isoformat()}, f)
+
+def sync_working_copy(mc):
+    """Обновляет рабочую копию проекта. Возвращает (успех, есть ли что обрабатывать).
+    В режиме incremental копия живет между запусками и докачиваются только изменения (pull_project)."""
+    is_working_copy = os.path.isdir(os.path.join(PROJECT_PATH, ".mergin"))
+
+    if SYNC_MODE != "incremental" or not is_working_copy:
+        if os.path.exists(PROJECT_PATH): shutil.rmtree(PROJECT_PATH)
+        try: mc.download_project(MERGIN_PROJECT, PROJECT_PATH)
+        except Exception as e: print(f"❌ Ошибка скачивания проекта: {e}", flush=True); return False, False
+        print(f"📥 Проект скачан целиком ({local_project_version(PROJECT_PATH)})", flush=True)
+        return True, True
+
+    local_version = local_project_version(PROJECT_PATH)
+    try:
+        server_version = mc.project_info(MERGIN_PROJECT).get("version")
     except Exception as e:
-        print(f"❌ MERGIN ERROR: {e}", flush=True); return
+        print(f"   ⚠️ Не удалось узнать версию на сервере: {e}", flush=True)
+        server_version = None
 
-    api_key = get_env('GEMINI_API_KEY')
-    if not api_key: return
-    client = genai.Client(api_key=api_key)
+    state = load_run_state()
+    if server_version and server_version == local_version and state.get("version") == local_version and state.get("clean"):
+        return True, False
 
-    print("🔍 Проверка связи с AI...", flush=True)
-    active_model_name = None
-    for m in MODEL_CANDIDATES:
+    if server_version != local_version:
         try:
-            client.models.generate_content(model=m, contents="Ping")
-            print(f"   ✅ Модель {m} отвечает!", flush=True)
-            active_model_name = m
-            break
+            mc.pull_project(PROJECT_PATH)
+            print(f"📥 Докачаны изменения: {local_version} -> {local_project_version(PROJECT_PATH)}", flush=True)
         except Exception as e:
-            print(f"   ⚠️ Модель {m} недоступна: {e}", flush=True)
-    
-    if not active_model_name:
-        print("❌ ОШИБКА: Ни одна модель Gemini не работает.", flush=True); return
+            print(f"   ⚠️ pull_project не удался ({e}), скачиваю проект заново...", flush=True)
+            shutil.rmtree(PROJECT_PATH, ignore_errors=True)
+            try: mc.download_project(MERGIN_PROJECT, PROJECT_PATH)
+            except Exception as e2: print(f"❌ Ошибка скачивания проекта: {e2}", flush=True); return False, False
+    return True, True
 
-    legal_knowledge = load_knowledge_base()
-    
-    if os.path.exists(PROJECT_PATH): shutil.rmtree(PROJECT_PATH)
-    try: mc.download_project(MERGIN_PROJECT, PROJECT_PATH)
-    except: print("❌ Ошибка скачивания проекта"); return
+def process_project(mc, get_ai, record_idle=True):
+    """Один цикл робота: синхронизация, новые дела, генерация, отправка, запись и push.
+    get_ai() лениво отдает клиент Gemini и прочее (см. init_ai). Возвращает "idle", "processed" или "error".
+    Метрики цикла пишутся в metrics.jsonl; record_idle=False — кроме пустых циклов (демон: их видно по heartbeat)."""
+    METRICS.reset()
+    status = "error"
+    journal = IncidentJournal(JOURNAL_FILE)
+    try:
+        status = run_cycle(mc, get_ai, journal)
+    finally:
+        journal.close()
+        if status != "idle":
+            METRICS.print_summary()
+        if status != "idle" or record_idle:
+            METRICS.write_jsonl(METRICS_FILE, project=MERGIN_PROJECT, status=status)
+    return status
+
+def files_changed_since(root, since):
+    """Байты файлов, измененных после since (оценка объема скачанного из Mergin)"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != ".mergin"]
+        for name in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if st.st_mtime >= since:
+                total += st.st_size
+    return total
+
+def group_duplicates(new_recs, points_wgs, cadastres):
+    """Группы fid повторных сообщений (тот же тип и кадастр, рядом по месту и времени).
+    Первый fid группы — первичное сообщение, по нему заводится дело."""
+    if not DEDUP_METERS or len(new_recs) < 2:
+        return [[idx] for idx in new_recs.index]
+    with stage("dedup"):
+        projected = points_wgs.to_crs(points_wgs.estimate_utm_crs())  # метры
+        times = None
+        if DEDUP_TIME_COLUMN in new_recs.columns:
+            times = pd.to_datetime(new_recs[DEDUP_TIME_COLUMN], errors="coerce", utc=True)
+        items = []
+        for idx, row in new_recs.iterrows():
+            t = times.loc[idx] if times is not None else None
+            items.append({
+                "key": idx,
+                "x": projected.loc[idx].x,
+                "y": projected.loc[idx].y,
+                "time": None if t is None or pd.isna(t) else t,
+                "group": (str(row.get('incident_type')), cadastres[idx]),
+            })
+        clusters = cluster_incidents(items, DEDUP_METERS, DEDUP_MINUTES)
+    merged = len(new_recs) - len(clusters)
+    if merged:
+        print(f"🔗 Повторных сообщений: {merged} — объединены в {sum(1 for c in clusters if len(c) > 1)} дел", flush=True)
+        METRICS.count("incidents.merged", merged)
+    return clusters
+
+def replay_journal(journal, pending_uids):
+    """Дела, доставленные прерванным запуском, но не подтвержденные push-ем, и которых нет среди is_sent=0
+    (запись в GPKG уже есть локально или потерялась при полной загрузке): {uid: (fid, обновление строки)}"""
+    replay = {}
+    for uid, steps in journal.uncommitted().items():
+        if uid in pending_uids or not delivered(steps):
+            continue  # пройдет обычным путем, продолжив с последнего шага
+        started = steps[STARTED]
+        fields = {"cadastre_id": started["cad_id"], "ai_complaint": steps[generated("RU")], "is_sent": 1}
+        replay[uid] = (started["fid"], fields)
+        replay.update({m_uid: (m_fid, fields) for m_uid, m_fid in started.get("members", {}).items()})
+    return replay
+
+def run_cycle(mc, get_ai, journal):
+    sync_started = time.time() - 1
+    with stage("mergin.sync"):
+        synced, changed = sync_working_copy(mc)
+    if synced and changed and os.path.isdir(PROJECT_PATH):
+        METRICS.count("mergin.download_bytes", files_changed_since(PROJECT_PATH, sync_started))
+    if not synced: return "error"
+    if not changed:
+        print("✅ Версия проекта не изменилась — работы нет.", flush=True); return "idle"
 
     try:
-        incidents = gpd.read_file(os.path.join(PROJECT_PATH, INCIDENTS_FILE))
-        photos_gdf = gpd.read_file(os.path.join(PROJECT_PATH, PHOTOS_FILE))
-    except: print("❌ Ошибка чтения GPKG"); return
+        # Только is_sent = 0 и нужные колонки; fid как индекс — по нему потом обновляем строки прямо в GPKG
+        with stage("gpkg.read"):
+            incidents = read_pending_incidents(os.path.join(PROJECT_PATH, INCIDENTS_FILE), INCIDENT_COLUMNS)
+            photo_index = read_photo_index(os.path.join(PROJECT_PATH, PHOTOS_FILE))
+    except: print("❌ Ошибка чтения GPKG"); return "error"
 
     if 'is_sent' not in incidents.columns: incidents['is_sent'] = 0
     incidents['is_sent'] = incidents['is_sent'].fillna(0).astype(int)
     new_recs = incidents[incidents['is_sent'] == 0]
-    
-    if new_recs.empty: 
-        print("✅ Новых данных нет.", flush=True); return
+
+    # Дела, доставленные прерванным запуском, но не дошедшие до проекта
+    replay = replay_journal(journal, set(new_recs['unique-id'].astype(str)))
+    if new_recs.empty and not replay:
+        save_run_state(local_project_version(PROJECT_PATH), clean=True)
+        print("✅ Новых данных нет.", flush=True); return "idle"
+    if new_recs.empty:
+        print(f"♻️ Дописываю в проект дела из журнала: {len(replay)}", flush=True)
+        return commit_updates(mc, journal, replay, clean=True)
+
+    with stage("ai.init"):
+        ai = get_ai()
+    if not ai: return "error"
+    client, selector, law_index = ai["client"], ai["selector"], ai["corpus"].current()
+    token_counter = ai["token_counter"]
+    gen_cache, limiter = ai["gen_cache"], ai["limiter"]
+    limiter.new_run()
+
+    # Готовые ответы пакетных заданий — в журнал; дальше эти дела идут как после обычной генерации
+    if ai["batch"].jobs:
+        with stage("gemini.batch_poll"):
+            for key, text in ai["batch"].poll(client).items():
+                uid, lang = key.rsplit(":", 1)
+                journal.record(uid, generated(lang), clean_response(text))
 
     garden_files = []
     for f in glob.glob(f"{PROJECT_PATH}/*.gpkg"):
@@ -270,126 +699,362 @@ def main():
 
     print(f"⚡ Новых дел: {len(new_recs)}", flush=True)
 
+    # --- КООРДИНАТЫ (одним пересчетом для всех новых дел) ---
+    if incidents.crs != "EPSG:4326":
+        points_wgs = new_recs.geometry.to_crs("EPSG:4326")
+    else: points_wgs = new_recs.geometry
+
+    # --- КАДАСТР ПО САДАМ (каждый слой читается один раз, поиск пакетный) ---
+    garden_hits = {}
+    need_lookup = [idx for idx, row in new_recs.iterrows() if not get_row_cadastre(row)]
+    if need_lookup and garden_files:
+        with stage("cadastre.load_layers"):
+            garden_layers = load_garden_layers(garden_files)
+        with stage("cadastre.lookup"):
+            garden_hits = find_garden_cadastres(points_wgs.loc[need_lookup], garden_layers)
+
+    # --- КАДАСТР КАЖДОГО СООБЩЕНИЯ ---
+    cadastres = {}
     for idx, row in new_recs.iterrows():
         uid = str(row.get('unique-id'))
-        print(f"\n--- Дело № {uid} ---", flush=True)
+        # 1. Сначала проверяем поле 'layers' в самом инциденте
+        cad_id = get_row_cadastre(row)
+        
+        # 2. Если не найдено, берем результат гео-пересечения с файлами садов
+        if not cad_id and idx in garden_hits:
+            cad_id, found_col, layer_name = garden_hits[idx]
+            if found_col:
+                print(f"   🎯 [{uid}] Найдено в поле '{found_col}' слоя {layer_name} -> {cad_id}", flush=True)
+            else:
+                print(f"   ⚠️ [{uid}] Поле layers не найдено, взято имя файла: {cad_id}", flush=True)
         
-        # --- ФОТО ---
-        attachments = []
-        incident_photo_dir = os.path.join(ARCHIVE_PATH, "PHOTOS", f"{datetime.now().strftime('%Y-%m-%d')}_{uid}")
-        os.makedirs(incident_photo_dir, exist_ok=True)
-
-        rel_photos = photos_gdf[photos_gdf['external_pk'] == uid]
-        if not rel_photos.empty:
-            for _, p_row in rel_photos.iterrows():
-                original = p_row.get('photo')
-                if original:
-                    possible_paths = [os.path.join(PROJECT_PATH, original), os.path.join(PROJECT_PATH, os.path.basename(original))]
-                    src = next((p for p in possible_paths if os.path.exists(p)), None)
-                    if src:
-                        dst = os.path.join(incident_photo_dir, os.path.basename(src))
-                        shutil.copy2(src, dst)
-                        attachments.append(dst)
+        cadastres[idx] = cad_id or "Не указан"
+
+    # --- ПОВТОРНЫЕ СООБЩЕНИЯ: одно дело на группу ---
+    clusters = group_duplicates(new_recs, points_wgs, cadastres)
+
+    # --- ПОДГОТОВКА ДЕЛ (координаты, фото, база знаний) ---
+    jobs = []
+    for members in clusters:
+        idx = members[0]
+        row = new_recs.loc[idx]
+        uid = str(row.get('unique-id'))
+        cad_id = cadastres[idx]
+        print(f"\n--- Дело № {uid} ---", flush=True)
 
         # --- КООРДИНАТЫ ---
-        if incidents.crs != "EPSG:4326":
-            p_geo = gpd.GeoDataFrame([row], crs=incidents.crs).to_crs("EPSG:4326").iloc[0].geometry
-        else: p_geo = row.geometry
+        p_geo = points_wgs.loc[idx]
         coords_str = f"{p_geo.y:.6f}, {p_geo.x:.6f}"
-        
-        # --- ОПРЕДЕЛЕНИЕ КАДАСТРОВОГО НОМЕРА ---
-        cad_id = None
-        
-        # 1. Сначала проверяем поле 'layers' в самом инциденте
-        if 'layers' in row:
-            val = row.get('layers')
-            if val and str(val).strip():
-                cad_id = str(val)
-        
-        # 2. Если не найдено, ищем гео-пересечение с файлами садов
-        if not cad_id:
-            for g_file in garden_files:
-                try:
-                    temp_gdf = gpd.read_file(g_file).to_crs("EPSG:4326")
-                    matches = temp_gdf[temp_gdf.contains(p_geo)]
-                    
-                    if not matches.empty:
-                        match_row = matches.iloc[0]
-                        # УМНЫЙ ПОИСК КОЛОНКИ: ищем что-то похожее на 'layer'
-                        found_col = None
-                        for col in match_row.index:
-                            if 'layer' in col.lower() or 'kadastr' in col.lower() or 'name' in col.lower():
-                                found_col = col
-                                break
-                        
-                        if found_col:
-                             cad_id = str(match_row[found_col])
-                             print(f"   🎯 Найдено в поле '{found_col}' слоя {os.path.basename(g_file)} -> {cad_id}", flush=True)
-                        else:
-                            cad_id = os.path.splitext(os.path.basename(g_file))[0]
-                            print(f"   ⚠️ Поле layers не найдено, взято имя файла: {cad_id}", flush=True)
-                            # Вывод доступных колонок для отладки
-                            print(f"   (Доступные колонки: {list(match_row.index)})", flush=True)
-                        break
-                except Exception as e: pass
-        
-        if not cad_id:
-            cad_id = "Не указан"
-
-        # --- ГЕНЕРАЦИЯ ---
-        responses = {"RU": "", "KZ": ""}
-
-        for lang in ["RU", "KZ"]:
-            print(f"   🧬 Генерация {lang}...", flush=True)
-            prompt = get_legal_prompt(lang, row.get('incident_type'), row.get('description'), cad_id, coords_str, legal_knowledge)
-            
-            contents_list = [prompt]
-            for img_path in attachments:
-                try:
-                    img = PIL.Image.open(img_path)
-                    contents_list.append(img)
-                except: pass
 
-            try:
-                resp = client.models.generate_content(
-                    model=active_model_name,
-                    contents=contents_list,
-                    config=types.GenerateContentConfig(temperature=0.0)
-                )
-                
-                clean_text = resp.text.replace("**", "").replace("##", "").replace("--- ДОКУМЕНТ:", "")
-                responses[lang] = clean_text
-                
-                subj = f"ALMA {'КОНСУЛЬТАЦИЯ' if lang=='RU' else 'КЕҢЕСІ'}: {cad_id}"
-                send_email_with_attachments(row.get('volunteer_email'), subj, clean_text, attachments)
-                time.sleep(2)
+        # Повторные сообщения: их фото, описания и волонтеры добавляются к первому
+        member_fids = {str(new_recs.at[m, 'unique-id']): int(m) for m in members[1:]}
+        if member_fids:
+            print(f"   🔗 Повторные сообщения: {', '.join(member_fids)}", flush=True)
+        photos, descriptions, emails = [], [], []
+        for m in members:
+            m_row = new_recs.loc[m]
+            photos += find_incident_photos(str(m_row.get('unique-id')), photo_index)
+            for values, value in [(descriptions, m_row.get('description')), (emails, m_row.get('volunteer_email'))]:
+                if value and str(value).strip() and value not in values:
+                    values.append(value)
+        description = row.get('description')
+        if len(descriptions) > 1:
+            description = "\n".join(str(d) for d in descriptions)
+
+        # Шаги, уже выполненные прерванным запуском
+        steps = journal.steps(uid)
+        if COMMITTED in steps:
+            journal.reset(uid); steps = {}
+        if STARTED not in steps:
+            journal.record(uid, STARTED, {"fid": int(idx), "cad_id": cad_id, "members": member_fids})
+
+        jobs.append({
+            "idx": idx,
+            "uid": uid,
+            "members": member_fids,
+            "cad_id": cad_id,
+            "coords": coords_str,
+            "incident_type": row.get('incident_type'),
+            "description": description,
+            "email": ", ".join(str(e) for e in emails),
+            "photos": photos,
+            "photo_dir": os.path.join(ARCHIVE_PATH, "PHOTOS", f"{datetime.now().strftime('%Y-%m-%d')}_{uid}"),
+            "legal_query": (law_index, token_counter, uid, row.get('incident_type'), description),
+            "legal_knowledge": None,
+            "legal_lock": threading.Lock(),
+            "responses": {},
+            "journal": steps,
+        })
+
+    active_jobs = defer_to_batch(client, selector, ai["batch"], jobs)
+    deferred = len(jobs) - len(active_jobs)
+
+    registry = RegistryWriter(GOOGLE_SHEET_NAME)
+    mailer = Mailer(EMAIL_RECIPIENTS)
+
+    # --- КОНВЕЙЕР: генерация RU/KZ параллельно, архив фото и отправка — отдельными стадиями ---
+    print(f"\n🏭 Обработка: до {MAX_PARALLEL_INCIDENTS} дел одновременно", flush=True)
+    with stage("pipeline"), \
+         ThreadPoolExecutor(max_workers=2 * MAX_PARALLEL_INCIDENTS) as gen_pool, \
+         ThreadPoolExecutor(max_workers=MAX_PARALLEL_INCIDENTS) as photo_pool, \
+         ThreadPoolExecutor(max_workers=1) as files_pool, \
+         ThreadPoolExecutor(max_workers=1) as delivery_pool:
+
+        for job in active_jobs:
+            job["photos_ready"] = photo_pool.submit(prepare_incident_photos, job["photos"])
+        stage_futures = [files_pool.submit(archive_incident_photos, job) for job in active_jobs]
+
+        gen_futures = {}
+        for job in active_jobs:
+            for lang in ["RU", "KZ"]:
+                f = gen_pool.submit(generate_text, client, gen_cache, limiter, selector, lang, job, ai["context_cache"], journal)
+                gen_futures[f] = (job, lang)
+
+        for f in as_completed(gen_futures):
+            job, lang = gen_futures[f]
+            job["responses"][lang] = f.result()
+            if len(job["responses"]) == 2 and job_generated(job):
+                stage_futures.append(delivery_pool.submit(deliver_incident, job, registry, mailer, journal))
+
+        for f in stage_futures:
+            try: f.result()
             except Exception as e:
-                print(f"   ❌ Ошибка AI {lang}: {e}", flush=True)
-
-        # --- GOOGLE SHEETS ---
-        sheet_row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M"),
-            uid, 
-            cad_id, 
-            row.get('incident_type'), 
-            coords_str,
-            responses["RU"], 
-            responses["KZ"], 
-            os.path.abspath(incident_photo_dir)
-        ]
-        log_to_google_sheet(sheet_row)
+                METRICS.count("pipeline.errors")
+                print(f"   ❌ Ошибка стадии обработки: {e}", flush=True)
+
+    registry.flush()
+    mailer.close()
+
+    # is_sent=1 только после доставки: по журналу письма и строка реестра должны быть записаны
+    generated_jobs = [job for job in active_jobs if job_generated(job)]
+    done_jobs = [job for job in generated_jobs if delivered(journal.steps(job["uid"]))]
+    if deferred:
+        print(f"📦 Ждут пакетного задания: {deferred} дел — будут отправлены в одном из следующих запусков", flush=True)
+    if len(generated_jobs) < len(active_jobs):
+        print(f"⚠️ Не сгенерировано дел: {len(active_jobs) - len(generated_jobs)} — останутся is_sent=0 до следующего запуска", flush=True)
+    if len(done_jobs) < len(generated_jobs):
+        print(f"⚠️ Не доставлено дел (почта или реестр): {len(generated_jobs) - len(done_jobs)} — "
+              f"останутся is_sent=0, следующий запуск повторит только недоставленное", flush=True)
+    print(f"📈 Запросов к AI: {limiter.requests}, повторов: {limiter.retries}, 429: {limiter.throttled}", flush=True)
+    METRICS.count("incidents.new", len(jobs))
+    METRICS.count("incidents.done", len(done_jobs))
+    METRICS.count("incidents.batched", deferred)
+    METRICS.count("gemini.requests", limiter.requests)
+    METRICS.count("gemini.retries", limiter.retries)
+    METRICS.count("gemini.throttled", limiter.throttled)
+
+    # Повторные сообщения помечаются обработанными вместе с первым
+    updates = {}
+    for job in done_jobs:
+        fields = {"cadastre_id": job["cad_id"], "ai_complaint": job["responses"]["RU"], "is_sent": 1}
+        updates[job["uid"]] = (job["idx"], fields)
+        updates.update({m_uid: (m_fid, fields) for m_uid, m_fid in job["members"].items()})
+    updates.update(replay)
+
+    if gen_cache.enabled:
+        print(f"🗃️ Кэш AI: попаданий {gen_cache.hits}, промахов {gen_cache.misses}", flush=True)
+
+    return commit_updates(mc, journal, updates, clean=len(done_jobs) == len(jobs))
 
-        incidents.at[idx, 'cadastre_id'] = cad_id
-        incidents.at[idx, 'ai_complaint'] = responses["RU"]
-        incidents.at[idx, 'is_sent'] = 1
+def defer_to_batch(client, selector, batch, jobs):
+    """Большая очередь генераций уходит в пакетное задание вместо 2×N обычных запросов.
+    Дела, ждущие пакетного задания (отправленного раньше или сейчас), в этом запуске не обрабатываются.
+    Возвращает дела для обычного конвейера."""
+    waiting = {key.rsplit(":", 1)[0] for key in batch.pending_keys()}
+    todo = [job for job in jobs if job["uid"] not in waiting]
+    missing = [(job, lang) for job in todo for lang in ["RU", "KZ"] if generated(lang) not in job["journal"]]
+    if BATCH_THRESHOLD and len(missing) >= BATCH_THRESHOLD:
+        print(f"\n📦 Запросов к AI: {len(missing)} — отправляю пакетным заданием (Batch API)", flush=True)
+        with stage("gemini.batch_submit"):
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_INCIDENTS) as pool:
+                for job in {job["uid"]: job for job, _ in missing}.values():
+                    job["photos_ready"] = pool.submit(prepare_incident_photos, job["photos"])
+                requests = [(f"{job['uid']}:{lang}", build_contents(lang, job, job_legal_knowledge(job))) for job, lang in missing]
+            submitted = batch.submit(client, selector.current(), requests, config=types.GenerateContentConfig(temperature=0.0))
+        waiting |= {key.rsplit(":", 1)[0] for key in submitted}
+    return [job for job in jobs if job["uid"] not in waiting]
 
-    # Сохраняем локально
-    incidents.to_file(os.path.join(PROJECT_PATH, INCIDENTS_FILE), driver="GPKG")
+def commit_updates(mc, journal, updates, clean):
+    """updates: {uid: (fid, поля строки)}. Сохраняем локально (UPDATE только этих строк, остальной файл
+    не трогаем) и отправляем в Mergin; после успешного push дела в журнале закрываются."""
+    if not updates:
+        save_run_state(local_project_version(PROJECT_PATH), clean=clean)
+        print("💾 Записывать в проект нечего.", flush=True)
+        return "processed"
+    try:
+        with stage("gpkg.write"):
+            update_gpkg_rows(os.path.join(PROJECT_PATH, INCIDENTS_FILE), dict(updates.values()))
+    except Exception as e:
+        print(f"❌ Ошибка записи в {INCIDENTS_FILE}: {e}", flush=True); return "error"
     
     # Безопасная синхронизация
-    sync_project_safely(mc, PROJECT_PATH)
+    with stage("mergin.push"):
+        pushed = sync_project_safely(mc, PROJECT_PATH)
+    if pushed:
+        journal.mark_committed(updates.keys())
+    save_run_state(local_project_version(PROJECT_PATH), clean=pushed and clean)
     
     print("💾 Готово.", flush=True)
+    return "processed"
+
+def connect_mergin():
+    try:
+        mc = MerginClient("https://app.merginmaps.com", login=get_env('MERGIN_USER'), password=get_env('MERGIN_PASS'))
+        print("✅ Mergin Maps: OK", flush=True)
+        return mc
+    except Exception as e:
+        print(f"❌ MERGIN ERROR: {e}", flush=True)
+        return None
+
+def init_ai(limiter=None, project_state=True):
+    """Клиент Gemini, рабочая модель, индекс законов, кэш и лимитер. None, если AI недоступен.
+    limiter — общий лимитер (несколько проектов, см. multi_project.py); project_state=False —
+    без кэша генераций и пакетных заданий проекта (их открывает open_project_state)."""
+    api_key = get_env('GEMINI_API_KEY')
+    if not api_key: return None
+    client = genai.Client(api_key=api_key)
+
+    print("🔍 Проверка связи с AI...", flush=True)
+    selector = ModelSelector(MODEL_CANDIDATES, MODEL_STATE_FILE)
+    if not selector.select(client):
+        print("❌ ОШИБКА: Ни одна модель Gemini не работает.", flush=True); return None
+
+    corpus = load_knowledge_base()
+    token_counter = TokenCounter()
+    token_counter.calibrate(client, selector.active, corpus.current().guidelines)
+    ai = {
+        "client": client,
+        "selector": selector,
+        "corpus": corpus,
+        "token_counter": token_counter,
+        "limiter": limiter or RateLimiter(rpm=GEMINI_RPM, budget=GEMINI_RUN_BUDGET),
+        "context_cache": ContextCacheManager(
+            client, corpus, build_cached_corpus,
+            state_path=CONTEXT_CACHE_FILE, enabled=CONTEXT_CACHE,
+        ),
+    }
+    if project_state:
+        ai.update(open_project_state())
+    return ai
+
+def open_project_state():
+    """Кэш генераций и пакетные задания текущего проекта (файлы в его ARCHIVE_PATH)"""
+    return {"gen_cache": GenerationCache(GEN_CACHE_FILE), "batch": BatchManager(BATCH_STATE_FILE)}
+
+def close_ai(ai):
+    if ai and "gen_cache" in ai:
+        ai["gen_cache"].close()
+
+def configure_project(project, project_path, archive_path, sheet_name=None, garden_keywords=None, recipients=None):
+    """Переключает робота на другой проект Mergin: рабочая копия, архив (журнал, состояние, метрики,
+    кэш генераций, фото), реестр, слои садов и получатели писем. Модель, база законов и
+    кэш контекста остаются общими (MODEL_STATE_FILE, CONTEXT_CACHE_FILE)."""
+    global MERGIN_PROJECT, PROJECT_PATH, ARCHIVE_PATH, GOOGLE_SHEET_NAME, GARDEN_KEYWORDS, EMAIL_RECIPIENTS
+    global RUN_STATE_FILE, METRICS_FILE, HEARTBEAT_FILE, JOURNAL_FILE, PHOTO_STORE_PATH, GEN_CACHE_FILE, BATCH_STATE_FILE
+    MERGIN_PROJECT = project
+    PROJECT_PATH = project_path
+    ARCHIVE_PATH = archive_path
+    RUN_STATE_FILE = os.path.join(ARCHIVE_PATH, "run_state.json")
+    METRICS_FILE = os.path.join(ARCHIVE_PATH, "metrics.jsonl")
+    HEARTBEAT_FILE = os.path.join(ARCHIVE_PATH, "heartbeat.json")
+    JOURNAL_FILE = os.path.join(ARCHIVE_PATH, "journal.sqlite")
+    PHOTO_STORE_PATH = os.path.join(ARCHIVE_PATH, "PHOTOS", "_store")
+    GEN_CACHE_FILE = os.path.join(ARCHIVE_PATH, "gen_cache.sqlite")
+    BATCH_STATE_FILE = os.path.join(ARCHIVE_PATH, "batch_jobs.json")
+    if sheet_name is not None: GOOGLE_SHEET_NAME = sheet_name
+    if garden_keywords is not None: GARDEN_KEYWORDS = [k.lower() for k in garden_keywords]
+    if recipients is not None: EMAIL_RECIPIENTS = list(recipients)
+    os.makedirs(os.path.join(ARCHIVE_PATH, "PHOTOS"), exist_ok=True)
+
+def main():
+    print("🚀 ЗАПУСК ALMA 8.9 (SYNC FIX + SMART COLUMNS)", flush=True)
+    
+    setup_google_credentials()
+
+    mc = connect_mergin()
+    if not mc: return "error"
+
+    # AI поднимаем только если есть новые дела
+    ai_holder = {}
+    def get_ai():
+        if "ai" not in ai_holder:
+            ai_holder["ai"] = init_ai()
+        return ai_holder["ai"]
+
+    try:
+        return process_project(mc, get_ai)
+    finally:
+        close_ai(ai_holder.get("ai"))
+
+def write_github_output(status, version_before):
+    """Результат запуска для следующих шагов workflow (steps.<id>.outputs.status / state_changed);
+    state_changed=false — рабочая копия и архив не изменились, кэш можно не сохранять. Вне GitHub Actions ничего не делает."""
+    path = os.environ.get("GITHUB_OUTPUT")
+    if not path: return
+    changed = status != "idle" or local_project_version(PROJECT_PATH) != version_before
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f"status={status}\nstate_changed={'true' if changed else 'false'}\n")
+
+def write_heartbeat(**fields):
+    """Файл здоровья демона: время последнего цикла и его результат"""
+    data = {"pid": os.getpid(), "time": datetime.now().isoformat(timespec="seconds"), **fields}
+    tmp = HEARTBEAT_FILE + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, HEARTBEAT_FILE)
+
+def run_daemon():
+    """Долгоживущий режим: все поднимается один раз, дальше опрос версии проекта каждые DAEMON_POLL_SECONDS"""
+    print(f"🚀 ЗАПУСК ALMA (DAEMON, опрос каждые {DAEMON_POLL_SECONDS} с)", flush=True)
+    if SYNC_MODE != "incremental":
+        print("⚠️ ALMA_SYNC_MODE=full: каждый цикл будет скачивать проект целиком", flush=True)
+
+    setup_google_credentials()
+    mc = connect_mergin()
+    ai = init_ai()
+    if not mc or not ai: return
+
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        print(f"\n🛑 Сигнал {signum}: завершаю после текущего цикла...", flush=True)
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    cycles, last_error = 0, None
+    try:
+        while not stop.is_set():
+            try:
+                status = process_project(mc, lambda: ai, record_idle=False)
+            except Exception as e:
+                status, last_error = "error", str(e)
+                print(f"❌ Ошибка цикла: {e}", flush=True)
+            if status == "error":
+                # Возможно, истекла сессия Mergin — переподключаемся на следующем цикле
+                mc = connect_mergin() or mc
+            cycles += 1
+            write_heartbeat(status=status, cycles=cycles, version=local_project_version(PROJECT_PATH), last_error=last_error)
+            stop.wait(DAEMON_POLL_SECONDS)
+    finally:
+        close_ai(ai)
+        write_heartbeat(status="stopped", cycles=cycles, version=local_project_version(PROJECT_PATH), last_error=last_error)
+        print("👋 Демон остановлен.", flush=True)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="ALMA: робот обработки инцидентов")
+    parser.add_argument("--daemon", action="store_true", help="не завершаться, а опрашивать проект Mergin")
+    parser.add_argument("--profile", action="store_true", help=f"профилировать запуск (cProfile -> {PROFILE_FILE})")
+    args = parser.parse_args()
+    version_before = local_project_version(PROJECT_PATH)
+    if args.daemon:
+        run_daemon()
+    elif args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            write_github_output(profiler.runcall(main), version_before)
+        finally:
+            profiler.dump_stats(PROFILE_FILE)
+            print(f"🔬 Профиль сохранен: {PROFILE_FILE}", flush=True)
+    else:
+        write_github_output(main(), version_before)
@@ -0,0 +1,75 @@
+"""Легкая инструментовка запуска: время стадий, счетчики (токены, байты, повторы).
+В конце запуска — строка в metrics.jsonl и сводная таблица в лог."""
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}    # имя -> [секунды, вызовы]
+            self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Замер стадии. Для стадий в пулах потоков время суммируется по всем вызовам."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                total = self.stages.setdefault(name, [0.0, 0])
+                total[0] += elapsed
+                total[1] += 1
+
+    def count(self, name, value=1):
+        if not value:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_usage(self, usage):
+        """Токены из usage_metadata ответа Gemini"""
+        if usage is None:
+            return
+        self.count("gemini.prompt_tokens", getattr(usage, "prompt_token_count", 0) or 0)
+        self.count("gemini.output_tokens", getattr(usage, "candidates_token_count", 0) or 0)
+        self.count("gemini.cached_tokens", getattr(usage, "cached_content_token_count", 0) or 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "wall_s": round(time.time() - self.started, 3),
+                "stages": {k: {"s": round(v[0], 3), "calls": v[1]} for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def write_jsonl(self, path, **extra):
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **extra, **self.snapshot()}
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"   ⚠️ Метрики не записаны: {e}", flush=True)
+
+    def print_summary(self):
+        snap = self.snapshot()
+        print(f"\n📏 Метрики запуска ({snap['wall_s']} с):", flush=True)
+        for name, v in sorted(snap["stages"].items(), key=lambda x: -x[1]["s"]):
+            print(f"   {name:<28} {v['s']:>9.3f} с  x{v['calls']}", flush=True)
+        for name, value in sorted(snap["counters"].items()):
+            print(f"   {name:<28} {value:>12}", flush=True)
+
+
+# Один набор метрик на процесс
+METRICS = Metrics()
+stage = METRICS.stage
+count = METRICS.count
@@ -0,0 +1,105 @@
+"""Выбор модели Gemini без платного "Ping" на каждом старте.
+Последняя рабочая модель хранится на диске с TTL; на следующую кандидатуру переключаемся,
+только когда реальные запросы к текущей модели падают (circuit breaker на каждую модель)."""
+import os
+import json
+import time
+import threading
+
+from metrics import count
+
+MODEL_STATE_TTL_HOURS = 6
+FAILURE_THRESHOLD = 3      # Подряд неудачных запросов до размыкания
+COOLDOWN_SECONDS = 600     # Сколько модель отдыхает после размыкания
+
+
+class ModelSelector:
+    def __init__(self, candidates, state_path, ttl_hours=MODEL_STATE_TTL_HOURS,
+                 failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.candidates = list(candidates)
+        self.state_path = state_path
+        self.ttl = ttl_hours * 3600
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.active = None
+        self.failures = {m: 0 for m in self.candidates}
+        self.open_until = {m: 0.0 for m in self.candidates}
+        self.saved_model, self.saved_at = None, 0.0
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save_state(self, model):
+        try:
+            if os.path.dirname(self.state_path):
+                os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            now = time.time()
+            with open(self.state_path, "w", encoding="utf-8") as f:
+                json.dump({"model": model, "checked": now}, f)
+            self.saved_model, self.saved_at = model, now
+        except Exception as e:
+            print(f"   ⚠️ Не удалось сохранить выбор модели: {e}", flush=True)
+
+    def select(self, client):
+        """Модель для работы: из файла, если запись свежая, иначе проверка кандидатов по очереди"""
+        state = self._load_state()
+        model = state.get("model")
+        if model in self.candidates and time.time() - state.get("checked", 0) < self.ttl:
+            self.active = model
+            self.saved_model, self.saved_at = model, state.get("checked", 0)
+            print(f"   ✅ Модель {model} (проверена ранее, без Ping)", flush=True)
+            return model
+        return self.probe(client)
+
+    def probe(self, client):
+        for m in self.candidates:
+            count("gemini.probes")  # платный "Ping" — должен случаться только при смене модели
+            try:
+                client.models.generate_content(model=m, contents="Ping")
+                print(f"   ✅ Модель {m} отвечает!", flush=True)
+                self.active = m
+                self._save_state(m)
+                return m
+            except Exception as e:
+                print(f"   ⚠️ Модель {m} недоступна: {e}", flush=True)
+        return None
+
+    def _available(self, model, now):
+        return self.open_until.get(model, 0.0) <= now
+
+    def current(self):
+        """Активная модель, если ее цепь замкнута, иначе первая доступная кандидатура"""
+        with self._lock:
+            now = time.time()
+            if self.active and self._available(self.active, now):
+                return self.active
+            for m in self.candidates:
+                if self._available(m, now):
+                    if m != self.active:
+                        print(f"   🔀 Переключаюсь на модель {m}", flush=True)
+                    self.active = m
+                    return m
+            # Все цепи разомкнуты — пробуем ту, что отдыхает дольше всех
+            self.active = min(self.candidates, key=lambda m: self.open_until[m])
+            return self.active
+
+    def report_success(self, model):
+        with self._lock:
+            self.failures[model] = 0
+            # Успешный реальный запрос продлевает TTL — следующий старт обойдется без Ping
+            refresh = self.saved_model != model or time.time() - self.saved_at > self.ttl / 2
+        if refresh:
+            self._save_state(model)
+
+    def report_failure(self, model):
+        with self._lock:
+            self.failures[model] = self.failures.get(model, 0) + 1
+            if self.failures[model] >= self.failure_threshold:
+                self.failures[model] = 0
+                self.open_until[model] = time.time() + self.cooldown
+                print(f"   ⚡ Модель {model} временно отключена на {self.cooldown} с", flush=True)
@@ -0,0 +1,149 @@
+"""Несколько проектов Mergin (районов) за один запуск: пул процессов, по проекту на процесс.
+Каждый процесс один раз подключается к Mergin и поднимает клиент Gemini (модель, база законов),
+дальше обрабатывает проекты по очереди. Квота Gemini общая для всех процессов (SharedRateLimiter).
+Рабочая копия, журнал, состояние, кэш генераций и фото у каждого проекта свои.
+
+    python multi_project.py projects.json
+
+projects.json — список проектов; кроме "project" все поля необязательные:
+    [{"project": "ALMA_exmachina/alma_bot", "path": "./project", "archive": "./ALMA_ARCHIVE",
+      "sheet": "ALMA_Registry", "garden_keywords": ["сады"], "recipients": ["district@example.org"]}]
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import main as robot
+from rate_limit import SharedRateLimiter
+from metrics import METRICS
+
+PROJECT_WORKERS = int(os.environ.get("ALMA_PROJECT_WORKERS", "2")) # Проектов одновременно (процессов)
+PROJECTS_ROOT = "./projects" # Рабочие копии проектов без явного "path"
+
+# Состояние процесса пула: Mergin и AI поднимаются один раз на процесс
+_worker = {}
+
+
+def project_slug(project):
+    return project.replace("/", "__")
+
+
+def load_projects(path):
+    """Список проектов с настройками по умолчанию; проект без "project" — ошибка конфигурации"""
+    with open(path, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    projects = []
+    for item in items:
+        if not item.get("project"):
+            raise ValueError(f"{path}: у проекта нет поля 'project': {item}")
+        slug = project_slug(item["project"])
+        projects.append({
+            "project": item["project"],
+            "path": item.get("path") or os.path.join(PROJECTS_ROOT, slug),
+            "archive": item.get("archive") or os.path.join(robot.ARCHIVE_PATH, "projects", slug),
+            "sheet": item.get("sheet", robot.GOOGLE_SHEET_NAME),
+            "garden_keywords": item.get("garden_keywords", robot.GARDEN_KEYWORDS),
+            "recipients": item.get("recipients", []),
+        })
+    paths = [p["path"] for p in projects] + [p["archive"] for p in projects]
+    if len(set(map(os.path.abspath, paths))) != len(paths):
+        raise ValueError(f"{path}: у проектов совпадают папки path/archive")
+    return projects
+
+
+def init_worker(limiter_state):
+    _worker["limiter_state"] = limiter_state
+    _worker["mc"] = robot.connect_mergin()
+
+
+def get_worker_ai():
+    """Клиент Gemini процесса: создается при первом проекте с новыми делами"""
+    if "ai" not in _worker:
+        limiter = SharedRateLimiter(_worker["limiter_state"], budget=robot.GEMINI_RUN_BUDGET)
+        _worker["ai"] = robot.init_ai(limiter=limiter, project_state=False)
+    return _worker["ai"]
+
+
+def run_project(cfg):
+    """Один проект в процессе пула. Возвращает статус и метрики цикла."""
+    started = time.time()
+    METRICS.reset()
+    robot.configure_project(cfg["project"], cfg["path"], cfg["archive"],
+                            cfg["sheet"], cfg["garden_keywords"], cfg["recipients"])
+    print(f"\n🗺️ Проект {cfg['project']} (процесс {os.getpid()})", flush=True)
+
+    project_ai = {}
+    def get_ai():
+        if "ai" not in project_ai:
+            ai = get_worker_ai()
+            project_ai["ai"] = ai and {**ai, **robot.open_project_state()}
+        return project_ai["ai"]
+
+    status = "error"
+    if _worker.get("mc") is None:
+        _worker["mc"] = robot.connect_mergin()
+    if _worker["mc"] is not None:
+        try:
+            status = robot.process_project(_worker["mc"], get_ai)
+        except Exception as e:
+            print(f"❌ Ошибка проекта {cfg['project']}: {e}", flush=True)
+        finally:
+            robot.close_ai(project_ai.get("ai"))
+        if status == "error":
+            # Возможно, истекла сессия Mergin — следующий проект этого процесса переподключится
+            _worker["mc"] = None
+
+    counters = METRICS.snapshot()["counters"]
+    return {
+        "project": cfg["project"],
+        "status": status,
+        "seconds": round(time.time() - started, 3),
+        "incidents": counters.get("incidents.done", 0),
+        "requests": counters.get("gemini.requests", 0),
+    }
+
+
+def print_report(results, wall):
+    print("\n📊 Проекты:", flush=True)
+    for r in results:
+        rate = r["incidents"] / r["seconds"] if r["seconds"] else 0.0
+        print(f"   {r['project']:<36} {r['status']:<10} {r['incidents']:>5} дел  {r['seconds']:>8.1f} с  "
+              f"{rate * 60:>7.2f} дел/мин  Gemini {r['requests']}", flush=True)
+    total = sum(r["incidents"] for r in results)
+    print(f"   {'ИТОГО':<36} {'':<10} {total:>5} дел  {wall:>8.1f} с  "
+          f"{total / wall * 60 if wall else 0.0:>7.2f} дел/мин  Gemini {sum(r['requests'] for r in results)}", flush=True)
+
+
+def run(projects, workers=PROJECT_WORKERS):
+    robot.setup_google_credentials()
+    # spawn: процессы не наследуют соединения и потоки родителя
+    context = multiprocessing.get_context("spawn")
+    limiter_state = SharedRateLimiter.create_state(robot.GEMINI_RPM, context)
+    workers = max(1, min(workers, len(projects)))
+    print(f"🚀 ЗАПУСК ALMA: проектов {len(projects)}, процессов {workers}", flush=True)
+
+    started = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(limiter_state,)) as pool:
+        futures = {pool.submit(run_project, cfg): cfg for cfg in projects}
+        for f in as_completed(futures):
+            try:
+                results.append(f.result())
+            except Exception as e:
+                print(f"❌ Процесс проекта {futures[f]['project']} упал: {e}", flush=True)
+                results.append({"project": futures[f]["project"], "status": "error", "seconds": 0.0, "incidents": 0, "requests": 0})
+    results.sort(key=lambda r: [p["project"] for p in projects].index(r["project"]))
+    print_report(results, time.time() - started)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ALMA: робот для нескольких проектов Mergin")
+    parser.add_argument("projects", help="JSON-файл со списком проектов")
+    parser.add_argument("--workers", type=int, default=PROJECT_WORKERS, help="проектов одновременно")
+    args = parser.parse_args()
+    run(load_projects(args.projects), args.workers)
@@ -0,0 +1,76 @@
+"""Подготовка фото: одно декодирование, уменьшенная JPEG-копия для модели и почты,
+архив оригиналов по хэшу содержимого (папки дел ссылаются на него жесткими ссылками)."""
+import io
+import os
+import shutil
+
+import PIL.Image
+import PIL.ImageOps
+
+from gen_cache import hash_bytes
+
+MAX_SIDE = 1600      # Длинная сторона копии для Gemini и писем, px
+JPEG_QUALITY = 85
+THUMB_SIDE = 320     # Миниатюра для истории чата
+THUMB_QUALITY = 70
+
+
+def downscale_jpeg(data, max_side=MAX_SIDE, quality=JPEG_QUALITY):
+    """Декодирует изображение один раз и возвращает JPEG не больше max_side по длинной стороне"""
+    with PIL.Image.open(io.BytesIO(data)) as img:
+        img = PIL.ImageOps.exif_transpose(img)  # телефоны пишут поворот в EXIF
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def prepare_photo_bytes(data, name="photo.jpg"):
+    """{'name', 'hash' (оригинала), 'key' (для кэша генераций), 'jpeg' (уменьшенная копия)}"""
+    original_hash = hash_bytes(data)
+    return {
+        "name": os.path.splitext(os.path.basename(name))[0] + ".jpg",
+        "hash": original_hash,
+        "key": f"{original_hash}@{MAX_SIDE}q{JPEG_QUALITY}",
+        "jpeg": downscale_jpeg(data),
+    }
+
+
+def make_thumbnail(jpeg):
+    """Маленькая копия уже подготовленного фото — вместо загруженного файла в истории сессии"""
+    return downscale_jpeg(jpeg, THUMB_SIDE, THUMB_QUALITY)
+
+
+def prepare_photo(src):
+    with open(src, "rb") as f:
+        data = f.read()
+    photo = prepare_photo_bytes(data, src)
+    photo["src"] = src
+    return photo
+
+
+def store_path(store_dir, content_hash, ext):
+    return os.path.join(store_dir, content_hash[:2], content_hash + ext.lower())
+
+
+def archive_photo(src, content_hash, store_dir, incident_dir):
+    """Кладет оригинал в хранилище по хэшу (если его там еще нет) и ставит жесткую ссылку в папку дела"""
+    stored = store_path(store_dir, content_hash, os.path.splitext(src)[1])
+    if not os.path.exists(stored):
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        tmp = stored + ".tmp"
+        shutil.copy2(src, tmp)
+        os.replace(tmp, stored)
+
+    os.makedirs(incident_dir, exist_ok=True)
+    dst = os.path.join(incident_dir, os.path.basename(src))
+    if os.path.exists(dst):
+        return dst
+    try:
+        os.link(stored, dst)
+    except OSError:
+        # Файловая система без жестких ссылок — обычная копия
+        shutil.copy2(stored, dst)
+    return dst
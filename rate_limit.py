@@ -0,0 +1,143 @@
+"""Общий ограничитель запросов к Gemini: token bucket, подстраивающийся под квоту,
+повторы 429/5xx с экспоненциальной задержкой и лимит запросов на один запуск. SharedRateLimiter делит одну квоту между процессами."""
+import re
+import time
+import random
+import threading
+import multiprocessing
+
+DEFAULT_RPM = 10          # Стартовая скорость (запросов в минуту)
+MIN_RPM = 2
+MAX_RPM = 60
+MAX_RETRIES = 5
+BASE_DELAY = 2.0          # Секунды, удваиваются на каждой попытке
+MAX_DELAY = 60.0
+
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+CODE_RE = re.compile(r"\b(429|500|502|503|504)\b")
+
+
+class BudgetExceeded(Exception):
+    """Исчерпан лимит запросов на этот запуск"""
+
+
+def error_code(e):
+    """HTTP-код ошибки SDK (google.genai.errors.APIError.code) или найденный в тексте ошибки"""
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    if isinstance(code, int):
+        return code
+    text = str(e)
+    if "RESOURCE_EXHAUSTED" in text:
+        return 429
+    m = CODE_RE.search(text)
+    return int(m.group(1)) if m else None
+
+
+class RateLimiter:
+    def __init__(self, rpm=DEFAULT_RPM, min_rpm=MIN_RPM, max_rpm=MAX_RPM, budget=None):
+        self.rpm = float(rpm)
+        self.min_rpm = float(min_rpm)
+        self.max_rpm = max(float(max_rpm), self.rpm)  # явно заданная скорость выше потолка — и есть потолок
+        self.budget = budget
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def new_run(self):
+        """Новый запуск (цикл демона): счетчики и бюджет сначала, подобранная скорость сохраняется"""
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.throttled = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        capacity = max(1.0, self.rpm / 6)  # всплеск не больше 10 секунд квоты
+        self.tokens = min(capacity, self.tokens + (now - self.last) * self.rpm / 60.0)
+        self.last = now
+
+    def acquire(self):
+        """Ждет свободный токен. Бросает BudgetExceeded, если лимит запуска исчерпан."""
+        while True:
+            with self._lock:
+                if self.budget is not None and self.requests >= self.budget:
+                    raise BudgetExceeded(f"лимит {self.budget} запросов на запуск исчерпан")
+                self._refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.requests += 1
+                    return
+                wait = (1.0 - self.tokens) * 60.0 / self.rpm
+            time.sleep(wait)
+
+    def on_success(self):
+        # Аддитивный рост: квота свободна — постепенно ускоряемся
+        with self._lock:
+            self.rpm = min(self.max_rpm, self.rpm + 1)
+
+    def on_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def on_throttle(self):
+        # Мультипликативное снижение после 429
+        with self._lock:
+            self.throttled += 1
+            self.rpm = max(self.min_rpm, self.rpm / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+
+
+def _shared_field(i):
+    return property(lambda self: self._state[i], lambda self, value: self._state.__setitem__(i, value))
+
+
+class SharedRateLimiter(RateLimiter):
+    """Тот же token bucket, но скорость и токены лежат в общей памяти: процессы пула
+    расходуют одну квоту API ключа, и 429 в одном процессе замедляет все.
+    Счетчики и бюджет запуска у каждого процесса свои."""
+
+    rpm = _shared_field(0)
+    tokens = _shared_field(1)
+    last = _shared_field(2)
+
+    def __init__(self, shared, min_rpm=MIN_RPM, max_rpm=MAX_RPM, budget=None):
+        self._state, self._lock = shared
+        self.min_rpm = float(min_rpm)
+        self.max_rpm = max(float(max_rpm), self.rpm)
+        self.budget = budget
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+
+    @staticmethod
+    def create_state(rpm=DEFAULT_RPM, context=None):
+        """Общее состояние (rpm, токены, время) и блокировка. Создается до пула
+        и передается процессам через initargs."""
+        context = context or multiprocessing.get_context()
+        return context.RawArray("d", [float(rpm), 1.0, time.monotonic()]), context.Lock()
+
+
+def call_with_retry(fn, limiter, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """Вызывает fn() через limiter. 429 и 5xx повторяются с задержкой base*2^n и случайным разбросом."""
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = fn()
+            limiter.on_success()
+            return result
+        except Exception as e:
+            code = error_code(e)
+            if code not in RETRYABLE_CODES or attempt >= max_retries:
+                raise
+            if code == 429:
+                limiter.on_throttle()
+            delay = min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.5, 1.5)
+            attempt += 1
+            limiter.on_retry()
+            print(f"   ⏳ Ошибка {code}, повтор {attempt}/{max_retries} через {delay:.1f} с", flush=True)
+            time.sleep(delay)
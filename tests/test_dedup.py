@@ -0,0 +1,38 @@
+"""Склейка повторных сообщений: группа не растягивается цепочкой за пределы лимитов"""
+from datetime import datetime, timedelta
+
+from dedup import cluster_incidents
+
+T0 = datetime(2026, 5, 1, 10, 0)
+
+
+def report(key, x, time=T0, y=0.0, group=("Срезка склона", "20-321-001")):
+    return {"key": key, "x": x, "y": y, "time": time, "group": group}
+
+
+def test_chain_does_not_stretch_past_distance():
+    items = [report(k, x) for k, x in [("a", 0), ("b", 40), ("c", 80), ("d", 120)]]
+    clusters = cluster_incidents(items, max_distance=50, max_minutes=120)
+    assert clusters == [["a", "b"], ["c", "d"]]
+    for cluster in clusters:
+        xs = [next(i["x"] for i in items if i["key"] == k) for k in cluster]
+        assert max(xs) - min(xs) <= 50
+
+
+def test_report_without_time_does_not_bridge_time_window():
+    items = [
+        report("morning", 0, T0),
+        report("no_time", 10, None),
+        report("evening", 20, T0 + timedelta(hours=5)),
+    ]
+    assert cluster_incidents(items, max_distance=50, max_minutes=120) == [["morning", "no_time"], ["evening"]]
+
+
+def test_groups_by_type_and_cadastre():
+    items = [report("a", 0), report("b", 5, group=("Вырубка", "20-321-001"))]
+    assert cluster_incidents(items, max_distance=50, max_minutes=120) == [["a"], ["b"]]
+
+
+def test_first_key_is_earliest_report():
+    items = [report("first", 0, T0), report("second", 30, T0 + timedelta(minutes=30)), report("third", 15, None)]
+    assert cluster_incidents(items, max_distance=50, max_minutes=120) == [["first", "second", "third"]]
@@ -0,0 +1,46 @@
+"""update_gpkg_rows на GeoPackage, созданном GDAL (с rtree-индексом и его триггерами)"""
+import sqlite3
+
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+shapely = pytest.importorskip("shapely")
+
+from gpkg_io import update_gpkg_rows, read_pending_incidents, register_spatial_functions
+
+
+@pytest.fixture
+def incidents_gpkg(tmp_path):
+    path = str(tmp_path / "incidents.gpkg")
+    df = gpd.GeoDataFrame(
+        {"unique-id": ["a", "b", "c"], "is_sent": [0, 0, 0]},
+        geometry=[shapely.Point(76.90, 43.20), shapely.Point(76.95, 43.22), shapely.Point(77.00, 43.25)],
+        crs="EPSG:4326",
+    )
+    df.to_file(path, layer="incidents", driver="GPKG", engine="pyogrio")
+    return path
+
+
+def test_update_rows_with_rtree_triggers(incidents_gpkg):
+    pending = read_pending_incidents(incidents_gpkg, ["unique-id", "is_sent"])
+    fid = pending.index[pending["unique-id"] == "b"][0]
+
+    changed = update_gpkg_rows(incidents_gpkg, {fid: {"is_sent": 1, "cadastre": "20-321-001"}})
+
+    assert changed == 1
+    pending = read_pending_incidents(incidents_gpkg, ["unique-id", "is_sent"])
+    assert sorted(pending["unique-id"]) == ["a", "c"]
+    with sqlite3.connect(incidents_gpkg) as conn:
+        assert conn.execute('SELECT "cadastre" FROM incidents WHERE fid = ?', (int(fid),)).fetchone() == ("20-321-001",)
+        assert conn.execute("SELECT count(*) FROM rtree_incidents_geom").fetchone() == (3,)
+
+
+def test_geometry_update_keeps_rtree(incidents_gpkg):
+    """Триггеры rtree при изменении геометрии считают конверт нашими ST_* функциями"""
+    with sqlite3.connect(incidents_gpkg) as conn:
+        register_spatial_functions(conn)
+        conn.execute("UPDATE incidents SET geom = (SELECT geom FROM incidents WHERE fid = 3) WHERE fid = 1")
+        minx, maxx, miny, maxy = conn.execute(
+            "SELECT minx, maxx, miny, maxy FROM rtree_incidents_geom WHERE id = 1").fetchone()
+    assert minx == pytest.approx(77.00) and maxx == pytest.approx(77.00)
+    assert miny == pytest.approx(43.25) and maxy == pytest.approx(43.25)
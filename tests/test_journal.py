@@ -0,0 +1,139 @@
+"""Продолжение прерванного запуска по журналу: main() с заглушками benchmark.py вместо Mergin, Gemini, SMTP и Sheets"""
+import os
+import json
+import time
+import sqlite3
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("geopandas")
+
+from gpkg_io import register_spatial_functions
+
+N_INCIDENTS = 2
+
+
+@pytest.fixture(scope="module")
+def bench(tmp_path_factory):
+    # benchmark задает окружение (секреты-заглушки, ALMA_NO_CACHE=1) до импорта main,
+    # а main при импорте создает ALMA_ARCHIVE в текущей папке
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("import"))
+    try:
+        benchmark = importlib.import_module("benchmark")
+        robot = importlib.import_module("main")
+    finally:
+        os.chdir(cwd)
+    return benchmark, robot
+
+
+@pytest.fixture
+def run(bench, tmp_path, monkeypatch):
+    """Проект из N_INCIDENTS дел; run() — один запуск main() в tmp_path"""
+    benchmark, robot = bench
+    template = str(tmp_path / "template")
+    benchmark.make_project(template, N_INCIDENTS, N_INCIDENTS, 1, 16, (64, 48))
+
+    args = SimpleNamespace(gen_latency=0.0, gen_error_rate=0.0, smtp_latency=0.0, smtp_error_rate=0.0,
+                           sheets_latency=0.0, mergin_latency=0.0, context_cache=False, batch_threshold=0)
+    monkeypatch.setattr(robot, "CONTEXT_CACHE", robot.CONTEXT_CACHE)
+    monkeypatch.setattr(robot, "BATCH_THRESHOLD", robot.BATCH_THRESHOLD)
+    for name in ["MerginClient", "MerginProject", "genai", "smtplib", "gspread", "ServiceAccountCredentials"]:
+        monkeypatch.setattr(robot, name, getattr(robot, name))
+    benchmark.install_fakes(robot, args)
+    benchmark.FakeMerginClient.template_dir = template
+    benchmark.FakeMerginClient.version = "v1"
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(robot.ARCHIVE_PATH, "PHOTOS"), exist_ok=True)
+    os.symlink(os.path.join(benchmark.REPO_DIR, "laws"), "laws")
+    with open(robot.MODEL_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"model": robot.MODEL_CANDIDATES[0], "checked": time.time()}, f)
+
+    return lambda: robot.main()
+
+
+def project_rows(robot):
+    with sqlite3.connect(os.path.join(robot.PROJECT_PATH, robot.INCIDENTS_FILE)) as conn:
+        return dict(conn.execute('SELECT "unique-id", is_sent FROM "Инцидент"').fetchall())
+
+
+def journal_uncommitted(robot):
+    journal = robot.IncidentJournal(robot.JOURNAL_FILE)
+    try:
+        return journal.uncommitted()
+    finally:
+        journal.close()
+
+
+def test_resume_after_smtp_failure(bench, run):
+    benchmark, robot = bench
+    benchmark.FakeSMTP.faults = benchmark.Faults(error_rate=1.0)
+
+    assert run() == "processed"
+    generations = benchmark.FakeModels.faults.calls
+    sheet_rows = len(benchmark.FakeSheet.rows)
+    assert generations == 2 * N_INCIDENTS
+    assert sheet_rows == 1 + N_INCIDENTS  # заголовок и строка на дело
+    assert benchmark.FakeSMTP.sent == 0
+    assert set(project_rows(robot).values()) == {0}  # без писем дело не помечается отправленным
+
+    benchmark.FakeSMTP.faults = benchmark.Faults()
+    assert run() == "processed"
+    assert benchmark.FakeModels.faults.calls == generations  # тексты взяты из журнала
+    assert len(benchmark.FakeSheet.rows) == sheet_rows       # строка реестра не повторилась
+    assert benchmark.FakeSMTP.sent == 2 * N_INCIDENTS
+    assert set(project_rows(robot).values()) == {1}
+    assert journal_uncommitted(robot) == {}
+
+
+def push_fails(robot):
+    def push_project(self, path):
+        raise robot.ClientError("push rejected")
+    return push_project
+
+
+def test_replay_journal_into_gpkg(bench, run, monkeypatch):
+    """Запись в GPKG локально есть (дел нет среди is_sent=0), но push не прошел: дела дописываются из журнала"""
+    benchmark, robot = bench
+    with monkeypatch.context() as m:
+        m.setattr(benchmark.FakeMerginClient, "push_project", push_fails(robot))
+        assert run() == "processed"
+    assert benchmark.FakeMerginClient.version == "v1"
+    uncommitted = journal_uncommitted(robot)
+    assert set(uncommitted) == set(project_rows(robot))
+
+    # Текст ответа из рабочей копии пропал — вернуть его может только журнал
+    with sqlite3.connect(os.path.join(robot.PROJECT_PATH, robot.INCIDENTS_FILE)) as conn:
+        register_spatial_functions(conn)  # для rtree-триггеров GDAL
+        conn.execute('UPDATE "Инцидент" SET ai_complaint = NULL')
+    generations = benchmark.FakeModels.faults.calls
+
+    assert run() == "processed"
+    assert benchmark.FakeModels.faults.calls == generations
+    assert benchmark.FakeMerginClient.version == "v2"
+    assert journal_uncommitted(robot) == {}
+    with sqlite3.connect(os.path.join(robot.PROJECT_PATH, robot.INCIDENTS_FILE)) as conn:
+        rows = conn.execute('SELECT "unique-id", is_sent, ai_complaint FROM "Инцидент"').fetchall()
+    assert {uid: (sent, text) for uid, sent, text in rows} == \
+        {uid: (1, steps[robot.generated("RU")]) for uid, steps in uncommitted.items()}
+
+
+def test_resend_skipped_after_lost_working_copy(bench, run, monkeypatch):
+    """Push не прошел, а рабочая копия потерялась: дела снова is_sent=0, но письма, реестр и генерация не повторяются"""
+    benchmark, robot = bench
+    with monkeypatch.context() as m:
+        m.setattr(benchmark.FakeMerginClient, "push_project", push_fails(robot))
+        assert run() == "processed"
+    assert len(journal_uncommitted(robot)) == N_INCIDENTS
+
+    os.rename(robot.PROJECT_PATH, robot.PROJECT_PATH + ".lost")
+    calls = benchmark.FakeModels.faults.calls, benchmark.FakeSMTP.sent, len(benchmark.FakeSheet.rows)
+
+    assert run() == "processed"
+    assert (benchmark.FakeModels.faults.calls, benchmark.FakeSMTP.sent, len(benchmark.FakeSheet.rows)) == calls
+    assert set(project_rows(robot).values()) == {1}
+    assert benchmark.FakeMerginClient.version == "v2"
+    assert journal_uncommitted(robot) == {}